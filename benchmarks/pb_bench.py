@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pb_fixtures import load_scraper
+from pb_server import FixtureServer
+
+# Offline throughput benchmark for pb-scrape.py
+# Runs parse_peak_list, scrape_peak_data and write_peak_data against the
+# local fixture server and reports pages/sec, parse and extraction time per
+# page and peak memory. Results can be saved with --json and compared with a
+# saved baseline with --baseline, failing if any rate regresses by more than
+# --tolerance.
+#
+# usage: python benchmarks/pb_bench.py [--list 500] [--latency 0.05] [--jitter 0.02]
+#                                      [--error-rate 0] [--rate 50] [--workers 8]
+#                                      [--json results.json] [--baseline baseline.json]
+
+# Metrics where a larger value is better; everything else is a cost
+HIGHER_IS_BETTER = {"list_rows_per_sec", "pages_per_sec", "csv_rows_per_sec"}
+
+def peak_rss_mb():
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		rss //= 1024
+	return rss / 1024
+	
+# Silences the scraper's progress output, which would dominate the timings
+class Quiet:
+	def __enter__(self):
+		self.stdout = sys.stdout
+		self.devnull = open(os.devnull, "w")
+		sys.stdout = self.devnull
+		
+	def __exit__(self, exc_type, exc_value, traceback):
+		sys.stdout = self.stdout
+		self.devnull.close()
+		
+def run(args):
+	scraper = load_scraper()
+	results = {}
+	with FixtureServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate) as server:
+		scraper.PB_PEAK_FORMAT = server.peak_format()
+		scraper.RETRY_BACKOFF = args.retry_backoff
+		with scraper.PageFetcher(rate=args.rate, workers=args.workers) as fetcher:
+			list_page = fetcher.fetch(server.list_url(args.list))
+			if list_page is None:
+				print("Unable to retrieve the list page")
+				return None
+				
+			# parse_peak_list
+			with Quiet():
+				start_time = time.perf_counter()
+				peaks = scraper.parse_peak_list(True, list_page)
+				elapsed = time.perf_counter() - start_time
+			results["list_rows"] = len(peaks)
+			results["list_rows_per_sec"] = len(peaks) / elapsed
+			results["list_parse_us_per_row"] = elapsed / max(1, len(peaks)) * 1e6
+			results["list_peak_rss_mb"] = peak_rss_mb()
+			
+			# scrape_peak_data
+			scraper.PEAK_EXTRACTOR.reset()
+			pool = ProcessPoolExecutor(args.parse_workers) if args.parse_workers else None
+			with Quiet():
+				start_time = time.perf_counter()
+				scraped_peaks = list(scraper.scrape_peak_data(peaks, fetcher, parser_pool=pool))
+				elapsed = time.perf_counter() - start_time
+			if pool:
+				pool.shutdown()
+			extractor = scraper.PEAK_EXTRACTOR
+			results["pages"] = extractor.pages
+			results["pages_per_sec"] = extractor.pages / elapsed
+			results["parse_us_per_page"] = extractor.parse_seconds / max(1, extractor.pages) * 1e6
+			results["extract_us_per_page"] = extractor.extract_seconds / max(1, extractor.pages) * 1e6
+			results["scrape_peak_rss_mb"] = peak_rss_mb()
+			
+		# write_peak_data
+		with tempfile.TemporaryDirectory() as output_dir:
+			with Quiet():
+				start_time = time.perf_counter()
+				row_count = scraper.write_peak_data(scraped_peaks, os.path.join(output_dir, "peaks.csv"))
+				elapsed = time.perf_counter() - start_time
+		results["csv_rows_per_sec"] = row_count / elapsed
+		results["write_peak_rss_mb"] = peak_rss_mb()
+		results["server_requests"] = server.requests
+		results["server_errors"] = server.errors
+	return results
+	
+def compare(results, baseline, tolerance):
+	regressions = []
+	for name, baseline_value in baseline.items():
+		if name not in results or not baseline_value or name.endswith("_rss_mb") or name.startswith("server_"):
+			continue
+		if name in HIGHER_IS_BETTER:
+			change = results[name] / baseline_value - 1
+		elif name.endswith("_us_per_page") or name.endswith("_us_per_row"):
+			change = baseline_value / results[name] - 1 if results[name] else 0
+		else:
+			continue
+		if change < -tolerance:
+			regressions.append((name, baseline_value, results[name], change))
+	return regressions
+	
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark pb-scrape.py against a local fixture server")
+	parser.add_argument("--list", default="500", help="corpus list id, or row count for a generated list")
+	parser.add_argument("--latency", type=float, default=0.05, help="server response latency in seconds")
+	parser.add_argument("--jitter", type=float, default=0.02, help="server latency jitter in seconds")
+	parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+	parser.add_argument("--rate", type=float, default=50, help="requests per second allowed by the fetcher")
+	parser.add_argument("--workers", type=int, default=8, help="fetch threads")
+	parser.add_argument("--parse-workers", type=int, default=0, help="parser processes (0 parses on the main thread)")
+	parser.add_argument("--retry-backoff", type=float, default=0.05, help="seconds before the first retry")
+	parser.add_argument("--json", metavar="FILE", help="save the results")
+	parser.add_argument("--baseline", metavar="FILE", help="compare with saved results")
+	parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fractional slowdown against the baseline")
+	args = parser.parse_args()
+	
+	results = run(args)
+	if results is None:
+		return 1
+	for name, value in results.items():
+		print("{0:<24} {1:>12.1f}".format(name, value))
+	if args.json:
+		with open(args.json, "w") as results_file:
+			json.dump(results, results_file, indent=2)
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			regressions = compare(results, json.load(baseline_file), args.tolerance)
+		for name, baseline_value, value, change in regressions:
+			print("REGRESSION {0}: {1:.1f} -> {2:.1f} ({3:+.0%})".format(name, baseline_value, value, change))
+		if regressions:
+			return 1
+	return 0
+	
+if __name__ == "__main__":
+	sys.exit(main())
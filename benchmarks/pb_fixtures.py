@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import random
+import sys
+
+# Fixture pages and helpers shared by the pb-scrape.py benchmarks
+# Pages are generated with the same markup peakbagger.com uses for the
+# elements the scraper reads, and saved under fixtures/ so every run parses
+# identical input.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRAPER_PATH = os.path.join(REPO_DIR, "pb-scrape.py")
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+FIXTURE_STATES = ["Washington", "Oregon", "California", "Colorado", "Alaska", "Montana", "Utah"]
+FIXTURE_RANGES = ["Cascade Range", "Sierra Nevada", "Rocky Mountains", "Olympic Mountains", "Alaska Range"]
+
+# pb-scrape.py can't be imported by name because of the dash in its filename
+def load_scraper():
+	if "pb_scrape" in sys.modules:
+		return sys.modules["pb_scrape"]
+	if REPO_DIR not in sys.path:
+		sys.path.insert(0, REPO_DIR)
+	spec = importlib.util.spec_from_file_location("pb_scrape", SCRAPER_PATH)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules["pb_scrape"] = module
+	spec.loader.exec_module(module)
+	return module
+	
+def fixture_pid(index):
+	return 1000 + index * 7
+	
+def list_page(row_count, seed=0):
+	rng = random.Random(seed)
+	parts = ["<html><head><title>Peak List</title></head><body>",
+			"<h1>Synthetic Peak List ({0} peaks)</h1>".format(row_count),
+			"<table class=\"gray\">",
+			"<tr><th colspan=\"5\">Peaks</th></tr>",
+			"<tr><th>Rank</th><th>Peak</th><th>Elev-Ft</th><th>Prom-Ft</th><th>Range</th></tr>"]
+	for index in range(row_count):
+		elevation = rng.randint(3000, 20000)
+		prominance = rng.randint(300, min(elevation, 15000))
+		parts.append("<tr><td>{0}.</td><td><a href=\"peak.aspx?pid={1}\">Synthetic Peak {0}</a></td>"
+					"<td>{2}</td><td>{3}</td><td><a href=\"range.aspx?rid={4}\">{5}</a></td></tr>".format(
+					index + 1, fixture_pid(index), elevation, prominance, index % 50, rng.choice(FIXTURE_RANGES)))
+	parts.append("</table></body></html>")
+	return "\n".join(parts).encode("utf-8")
+	
+def peak_page(pid):
+	rng = random.Random(pid)
+	lat = rng.uniform(32.0, 49.0)
+	lon = -rng.uniform(104.0, 124.0)
+	state = rng.choice(FIXTURE_STATES)
+	rows = ["<tr><td>Elevation:</td><td>{0} feet</td></tr>".format(rng.randint(3000, 20000)),
+			"<tr><td>Prominence:</td><td>{0} ft</td></tr>".format(rng.randint(300, 5000))]
+	# Padding rows the scraper has to skip over, as on the real pages
+	for index in range(rng.randint(8, 16)):
+		rows.append("<tr><td>Detail {0}:</td><td>{1}</td></tr>".format(index, "x" * rng.randint(20, 200)))
+	rows.append("<tr><td>Latitude/Longitude (WGS84)</td><td>{0:.0f}&deg; N, {1:.0f}&deg; W<br/>"
+				"{0:.6f}, {1:.6f} (Dec Deg)<br/>{2:.0f} E {3:.0f} N Zone 10 (UTM)</td></tr>".format(
+				lat, lon, rng.uniform(1e5, 9e5), rng.uniform(1e6, 9e6)))
+	if rng.random() < 0.3:
+		rows.append("<tr><td>Alternate Name(s):</td><td>Synthetic Alt {0}</td></tr>".format(pid))
+	rows.append("<tr><td>State/Province</td><td>{0}{1}</td></tr>".format(state, " (Highest Point)" if rng.random() < 0.05 else ""))
+	return ("<html><head><title>Peak {0}</title></head><body><h1>Synthetic Peak {0}</h1>"
+			"<table class=\"gray\">{1}</table>"
+			"<table class=\"gray\"><tr><td>Ascents</td><td>{2}</td></tr></table>"
+			"</body></html>".format(pid, "".join(rows), rng.randint(0, 500))).encode("utf-8")
+	
+# Writes the list fixture of the given size if it doesn't exist yet
+# and returns its path
+def save_list_fixture(row_count):
+	os.makedirs(FIXTURE_DIR, exist_ok=True)
+	path = os.path.join(FIXTURE_DIR, "list_{0}.html".format(row_count))
+	if not os.path.exists(path):
+		with open(path, "wb") as fixture_file:
+			fixture_file.write(list_page(row_count))
+	return path
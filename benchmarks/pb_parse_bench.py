@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from pb_fixtures import load_scraper, save_list_fixture
+
+# Measures list page parse rate and peak memory for the incremental parser
+# used by iter_peak_list against a whole-tree html.fromstring/xpath parse.
+# Each run happens in a fresh process and reports how far the parse raised
+# peak RSS above what the fixture and the loaded modules already use.
+#
+# usage: python benchmarks/pb_parse_bench.py [--sizes 1000 10000 100000]
+
+DEFAULT_SIZES = [1000, 10000, 50000, 100000]
+
+class PageContent:
+	def __init__(self, content):
+		self.content = content
+
+def peak_rss_kb():
+	import resource
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# macOS reports bytes, Linux kilobytes
+	if sys.platform == "darwin":
+		rss //= 1024
+	return rss
+	
+def parse_with_tree(scraper, content):
+	from lxml import html
+	tree = html.fromstring(content)
+	row_count = 0
+	for peak_row in tree.xpath("//table[@class=\"gray\"]")[0].xpath(".//tr")[2:]:
+		peak_columns = peak_row.xpath(".//td")
+		int(peak_columns[0].text.replace('.',''))
+		peak_columns[1].xpath("./a/text()")[0]
+		int(peak_columns[1].xpath("./a/@href")[0].split("pid=")[1])
+		int(peak_columns[2].text)
+		int(peak_columns[3].text)
+		peak_columns[4].xpath("./a/text()")[0]
+		row_count += 1
+	return row_count
+	
+def parse_with_stream(scraper, content):
+	row_count = 0
+	for peak in scraper.iter_peak_list(True, PageContent(content)):
+		row_count += 1
+	return row_count
+	
+PARSERS = {"tree": parse_with_tree, "stream": parse_with_stream}
+
+def run_child(parser_name, path):
+	with open(path, "rb") as fixture_file:
+		content = fixture_file.read()
+	# loading the scraper also imports lxml, so neither parser pays for imports
+	scraper = load_scraper()
+	base_rss = peak_rss_kb()
+	# iter_peak_list prints every row, which would dominate the timing
+	with open(os.devnull, "w") as devnull:
+		stdout = sys.stdout
+		sys.stdout = devnull
+		try:
+			start_time = time.perf_counter()
+			row_count = PARSERS[parser_name](scraper, content)
+			elapsed = time.perf_counter() - start_time
+		finally:
+			sys.stdout = stdout
+	print(json.dumps({"rows": row_count, "seconds": elapsed,
+					"peak_rss_kb": peak_rss_kb(), "base_rss_kb": base_rss}))
+	
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark peak list parsing")
+	parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+	parser.add_argument("--child", nargs=2, metavar=("PARSER", "PATH"), help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	
+	if args.child:
+		run_child(*args.child)
+		return
+		
+	print("{0:>8} {1:>7} {2:>12} {3:>12} {4:>16}".format("rows", "parser", "rows/sec", "seconds", "RSS growth (MB)"))
+	for size in args.sizes:
+		path = save_list_fixture(size)
+		for parser_name in PARSERS:
+			output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", parser_name, path])
+			result = json.loads(output.decode().strip().splitlines()[-1])
+			print("{0:>8} {1:>7} {2:>12.0f} {3:>12.3f} {4:>16.1f}".format(
+				result["rows"], parser_name, result["rows"] / result["seconds"],
+				result["seconds"], (result["peak_rss_kb"] - result["base_rss_kb"]) / 1024))
+				
+if __name__ == "__main__":
+	main()
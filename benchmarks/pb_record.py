@@ -0,0 +1,45 @@
+import argparse
+import os
+import sys
+from urllib.parse import urlsplit, parse_qs
+
+from pb_fixtures import load_scraper
+from pb_server import CORPUS_DIR
+
+# Records a peakbagger list page and all of its peak pages into the
+# benchmark corpus, so pb_server.py can replay real markup offline.
+# Requests go through the scraper's rate-limited page fetcher.
+#
+# usage: python benchmarks/pb_record.py "https://www.peakbagger.com/list.aspx?lid=5001"
+
+def main():
+	parser = argparse.ArgumentParser(description="Record a peak list into the benchmark corpus")
+	parser.add_argument("link", help="peakbagger list URL")
+	parser.add_argument("--corpus-dir", default=CORPUS_DIR)
+	args = parser.parse_args()
+	
+	list_ids = parse_qs(urlsplit(args.link).query).get("lid")
+	if not list_ids:
+		print("List link has no lid parameter")
+		return 1
+		
+	scraper = load_scraper()
+	os.makedirs(args.corpus_dir, exist_ok=True)
+	with scraper.PageFetcher() as fetcher:
+		list_page = fetcher.fetch(args.link)
+		if list_page is None:
+			return 1
+		with open(os.path.join(args.corpus_dir, "list_{0}.html".format(list_ids[0])), "wb") as page_file:
+			page_file.write(list_page.content)
+		peaks = scraper.parse_peak_list(False, list_page)
+		link_for = lambda peak: scraper.PB_PEAK_FORMAT.format(peak.pid)
+		for peak, peak_page in fetcher.fetch_stream(peaks, link_for):
+			if peak_page is None:
+				continue
+			with open(os.path.join(args.corpus_dir, "peak_{0}.html".format(peak.pid)), "wb") as page_file:
+				page_file.write(peak_page.content)
+	print("Recorded {0} peaks".format(len(peaks)))
+	return 0
+	
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from pb_fixtures import BENCH_DIR, list_page, peak_page
+
+# Local stand-in for peakbagger.com serving list and peak pages with
+# configurable latency, jitter and error rate.
+# Pages come from the recorded corpus (see pb_record.py) when present,
+# otherwise they are generated. A list id that isn't in the corpus is taken
+# as the number of rows in a generated list.
+#
+# usage: python benchmarks/pb_server.py [--port 8080] [--latency 0.2] [--jitter 0.05] [--error-rate 0.01]
+
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+
+class FixtureServer:
+	def __init__(self, port=0, latency=0, jitter=0, error_rate=0, corpus_dir=CORPUS_DIR, seed=0):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.corpus_dir = corpus_dir
+		self.rng = random.Random(seed)
+		self.rng_lock = threading.Lock()
+		self.requests = 0
+		self.errors = 0
+		self.bytes_sent = 0
+		
+		fixture_server = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			
+			def do_GET(self):
+				fixture_server.handle(self)
+				
+			def log_message(self, format, *args):
+				pass
+				
+		self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		self.httpd.daemon_threads = True
+		self.thread = None
+		
+	@property
+	def url(self):
+		return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+		
+	def list_url(self, list_id):
+		return "{0}/list.aspx?lid={1}".format(self.url, list_id)
+		
+	def peak_format(self):
+		return self.url + "/peak.aspx?pid={0}"
+		
+	def __enter__(self):
+		self.start()
+		return self
+		
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+		
+	def start(self):
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		self.thread.join()
+		
+	def corpus_page(self, name):
+		path = os.path.join(self.corpus_dir, name)
+		if os.path.exists(path):
+			with open(path, "rb") as page_file:
+				return page_file.read()
+		return None
+		
+	def page(self, path, query):
+		if path.endswith("/peak.aspx") and "pid" in query:
+			pid = int(query["pid"][0])
+			return self.corpus_page("peak_{0}.html".format(pid)) or peak_page(pid)
+		if path.endswith("/list.aspx") and "lid" in query:
+			list_id = query["lid"][0]
+			content = self.corpus_page("list_{0}.html".format(list_id))
+			if content is None and list_id.isdigit():
+				content = list_page(int(list_id))
+			return content
+		return None
+		
+	def handle(self, request):
+		with self.rng_lock:
+			delay = max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+			fail = self.rng.random() < self.error_rate
+			self.requests += 1
+			if fail:
+				self.errors += 1
+		time.sleep(delay)
+		
+		url = urlsplit(request.path)
+		content = None if fail else self.page(url.path, parse_qs(url.query))
+		if fail:
+			status = 503
+			content = b"Service Unavailable"
+		elif content is None:
+			status = 404
+			content = b"Not Found"
+		else:
+			status = 200
+		request.send_response(status)
+		request.send_header("Content-Type", "text/html; charset=utf-8")
+		request.send_header("Content-Length", str(len(content)))
+		request.end_headers()
+		request.wfile.write(content)
+		with self.rng_lock:
+			self.bytes_sent += len(content)
+			
+def main():
+	parser = argparse.ArgumentParser(description="Serve peakbagger fixture pages locally")
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+	parser.add_argument("--jitter", type=float, default=0, help="random +/- seconds added to the latency")
+	parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+	args = parser.parse_args()
+	
+	server = FixtureServer(args.port, args.latency, args.jitter, args.error_rate)
+	print("Serving on {0} (list pages at {1})".format(server.url, server.list_url("<lid or row count>")))
+	try:
+		server.httpd.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.httpd.server_close()
+	
+if __name__ == "__main__":
+	main()
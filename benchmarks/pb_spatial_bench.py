@@ -0,0 +1,85 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pb_spatial import PeakIndex, haversine_km
+
+# Compares PeakIndex radius, nearest neighbour and bounding box queries
+# against a linear scan of the same peaks, checking both give the same answer.
+#
+# usage: python benchmarks/pb_spatial_bench.py [--sizes 1000 10000 100000] [--queries 200]
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+def random_points(count, rng):
+	# Cluster the points like real peak lists: mostly in mountain ranges
+	centers = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for index in range(40)]
+	points = []
+	for index in range(count):
+		center_lat, center_lon = rng.choice(centers)
+		lat = max(-90, min(90, rng.gauss(center_lat, 2)))
+		lon = (rng.gauss(center_lon, 3) + 180) % 360 - 180
+		points.append((lat, lon, index))
+	return points
+	
+def scan_within(points, lat, lon, radius_km):
+	found = []
+	for point in points:
+		distance = haversine_km(lat, lon, point[0], point[1])
+		if distance <= radius_km:
+			found.append((distance, point))
+	found.sort(key=lambda entry: entry[0])
+	return found
+	
+def scan_nearest(points, lat, lon, k):
+	return sorted(((haversine_km(lat, lon, point[0], point[1]), point) for point in points), key=lambda entry: entry[0])[:k]
+	
+def scan_box(points, min_lat, min_lon, max_lat, max_lon):
+	return [point for point in points if min_lat <= point[0] <= max_lat and min_lon <= point[1] <= max_lon]
+	
+def time_queries(function, queries):
+	start_time = time.perf_counter()
+	results = [function(*query) for query in queries]
+	return (time.perf_counter() - start_time) / len(queries) * 1e6, results
+	
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark spatial peak queries")
+	parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+	parser.add_argument("--queries", type=int, default=200)
+	args = parser.parse_args()
+	
+	rng = random.Random(1)
+	print("{0:>8} {1:>10} {2:>12} {3:>12} {4:>9}".format("peaks", "query", "index us", "scan us", "speedup"))
+	for size in args.sizes:
+		points = random_points(size, rng)
+		start_time = time.perf_counter()
+		index = PeakIndex(points)
+		build_seconds = time.perf_counter() - start_time
+		
+		# Query around existing peaks, as trip planning does
+		origins = [rng.choice(points) for query in range(args.queries)]
+		cases = [
+			("radius", index.within, scan_within, [(lat, lon, 30) for lat, lon, item in origins]),
+			("nearest", index.nearest, scan_nearest, [(lat, lon, 10) for lat, lon, item in origins]),
+			("box", index.bounding_box, scan_box, [(lat - 0.5, lon - 0.5, lat + 0.5, lon + 0.5) for lat, lon, item in origins]),
+		]
+		for name, index_query, scan_query, queries in cases:
+			index_us, index_results = time_queries(index_query, queries)
+			scan_us, scan_results = time_queries(lambda *query: scan_query(points, *query), queries)
+			for index_result, scan_result in zip(index_results, scan_results):
+				if name == "box":
+					index_result, scan_result = sorted(index_result), sorted(scan_result)
+				else:
+					index_result = [round(distance, 9) for distance, point in index_result]
+					scan_result = [round(distance, 9) for distance, point in scan_result]
+				if index_result != scan_result:
+					print("Mismatch in {0} query".format(name))
+					break
+			print("{0:>8} {1:>10} {2:>12.1f} {3:>12.1f} {4:>8.1f}x".format(size, name, index_us, scan_us, scan_us / index_us))
+		print("{0:>8} {1:>10} {2:>12.0f} ms build".format(size, "", build_seconds * 1000))
+		
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,83 @@
+import argparse
+import time
+
+import numpy as np
+from arduino_proto import ArduinoLogger, SETUP_TIMEOUT
+from arduino_sim import ArduinoSimulator
+
+# Measures ArduinoLogger against the pty simulator: samples per second,
+# latency from the simulator sending a sample to the logger queueing it,
+# and CPU time of the logger thread per sample. Linux only.
+#
+# usage: python arduino_bench.py [--duration 5] [--scenario poll]
+
+# name: (logger options, simulator options)
+SCENARIOS = {
+	"poll": ({"update_interval_ms": 0}, {}),
+	"poll-10ms": ({"update_interval_ms": 10}, {}),
+	"poll-delay": ({"update_interval_ms": 0}, {"response_delay_ms": 2}),
+	"poll-corrupt": ({"update_interval_ms": 0}, {"corrupt_rate": 0.01}),
+	"poll-drop": ({"update_interval_ms": 0}, {"drop_rate": 0.001}),
+	"stream-1ms": ({"update_interval_ms": 1, "streaming": True}, {}),
+	"stream-corrupt": ({"update_interval_ms": 1, "streaming": True}, {"corrupt_rate": 0.01}),
+}
+
+# how often queued samples are collected while running, in seconds
+DRAIN_INTERVAL = 0.05
+
+def run_scenario(logger_options, simulator_options, duration):
+	simulator = ArduinoSimulator(seed=1, **simulator_options)
+	simulator.start()
+	logger = ArduinoLogger(simulator.port, **logger_options)
+	logger.start_thread()
+	try:
+		if not logger.setup_event.wait(SETUP_TIMEOUT):
+			raise RuntimeError('logger did not finish setup: {0}'.format(logger.thread_error_msg))
+		cpu_clock = time.pthread_getcpuclockid(logger.main_thread.ident)
+		batches = []
+		start_cpu = time.clock_gettime(cpu_clock)
+		start_time = time.monotonic()
+		logger.start_polling()
+		while time.monotonic() - start_time < duration:
+			time.sleep(DRAIN_INTERVAL)
+			batches.append(logger.get_queued_data().copy())
+		logger.stop_polling()
+		elapsed = time.monotonic() - start_time
+		cpu_seconds = time.clock_gettime(cpu_clock) - start_cpu
+		batches.append(logger.get_queued_data().copy())
+	finally:
+		logger.stop_thread()
+		simulator.stop()
+	samples = np.concatenate(batches)
+	received_times = samples['timestamp'] + logger.polling_start_time
+	# msgIds wrap at 2**16; gaps between received samples are far shorter,
+	# so adding up the gaps recovers the simulator's message numbers
+	msg_ids = samples['msgId'].astype(np.int64)
+	message_numbers = msg_ids[:1] + np.concatenate(([0], np.cumsum(np.diff(msg_ids) & 0xFFFF)))[:len(msg_ids)]
+	sent_times = np.array(simulator.sent_times)[message_numbers]
+	latencies = received_times - sent_times
+	latencies = latencies[np.isfinite(latencies)]
+	return {"samples": len(samples), "rate": len(samples) / elapsed,
+		"latency_p50": np.percentile(latencies, 50) if len(latencies) else np.nan,
+		"latency_p99": np.percentile(latencies, 99) if len(latencies) else np.nan,
+		"cpu_per_sample": cpu_seconds / len(samples) if len(samples) else np.nan,
+		"crc_failures": logger.stats.crc_failures, "dropped": logger.poll_data_queue.dropped}
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark ArduinoLogger against a simulated board")
+	parser.add_argument("--duration", type=float, default=5)
+	parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+		help="scenario to run, may be repeated (default: all)")
+	args = parser.parse_args()
+
+	print("{0:>15} {1:>8} {2:>10} {3:>11} {4:>11} {5:>11} {6:>5} {7:>7}".format(
+		"scenario", "samples", "samples/s", "p50 lat ms", "p99 lat ms", "cpu us/smp", "crc", "dropped"))
+	for name in args.scenario or SCENARIOS:
+		logger_options, simulator_options = SCENARIOS[name]
+		result = run_scenario(logger_options, simulator_options, args.duration)
+		print("{0:>15} {1:>8} {2:>10.0f} {3:>11.3f} {4:>11.3f} {5:>11.1f} {6:>5} {7:>7}".format(
+			name, result["samples"], result["rate"], result["latency_p50"] * 1000, result["latency_p99"] * 1000,
+			result["cpu_per_sample"] * 1e6, result["crc_failures"], result["dropped"]))
+
+if __name__ == "__main__":
+	main()
@@ -1,40 +1,425 @@
 import asyncio
+import math
+import selectors
+import socket
 import threading
 import serial 
 import time
 import ctypes
+import struct
+import numpy as np
+from session_log import SessionRecorder, unused_filename
+from logger_stats import LoggerStats, StatsReporter
 
 ARDUINO_BAUD_RATE = 115200
 
+# What a port that has gone away raises: pyserial's own exception, OSError
+# from reads and, on POSIX, termios.error from flushing the buffers
+try:
+	import termios
+	PORT_ERRORS = (serial.SerialException, OSError, termios.error)
+except ImportError:
+	PORT_ERRORS = (serial.SerialException, OSError)
+
 # time until setup times out in seconds
 SETUP_TIMEOUT = 15
 # time until read times out in seconds
 SERIAL_TIMEOUT = 0.5
 
-# time to sleep for main thread in milliseconds
-INTERNAL_UPDATE_RATE_MS = 50
+# time a poll may run late before the missed slots are skipped in milliseconds
+MAX_POLL_LATENESS_MS = 1000
+
+ACK = 0x06
+# polynomial used by the firmware's CRC16 (avr-libc _crc16_update)
+CRC16_POLY = 0xA001
+
+def make_crc16_table():
+	table = []
+	for byte in range(256):
+		crc = byte
+		for i in range(0, 8):
+			if crc & 1:
+				crc = (crc >> 1) ^ CRC16_POLY
+			else:
+				crc = (crc >> 1)
+		table.append(crc)
+	return table
+
+# CRC of every possible byte, so each byte costs one lookup instead of 8 shifts
+CRC16_TABLE = make_crc16_table()
+CRC16_TABLE_NP = np.array(CRC16_TABLE, dtype=np.uint16)
+
+# CRC16 of a whole buffer
+def crc16(data, crc=0):
+	table = CRC16_TABLE
+	for byte in data:
+		crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+	return crc
+
+# CRC16 of many equal length frames at once
+# frames is a 2D uint8 array with one frame per row; returns one CRC per row
+def crc16_frames(frames):
+	crcs = np.zeros(frames.shape[0], dtype=np.uint16)
+	for column in range(frames.shape[1]):
+		crcs = (crcs >> 8) ^ CRC16_TABLE_NP[(crcs ^ frames[:, column]) & 0xFF]
+	return crcs
+
+# Checks a buffer of back-to-back replies (ACK + checksum + payload)
+# Returns a boolean array marking the frames with a valid ACK and checksum
+def validate_frames(buffer, payload_len):
+	frame_len = payload_len + 3
+	frame_count = len(buffer) // frame_len
+	frames = np.frombuffer(buffer, dtype=np.uint8, count=frame_count * frame_len).reshape(frame_count, frame_len)
+	checksums = frames[:, 1].astype(np.uint16) | (frames[:, 2].astype(np.uint16) << 8)
+	return (frames[:, 0] == ACK) & (crc16_frames(frames[:, 3:]) == checksums)
+
+# Streaming protocol
+# Once started, the device pushes one frame per sample:
+#	sync word (0xAA 0x55)
+#	payload length (1 byte)
+#	payload (SerialDataMsg)
+#	CRC16 of the length byte and payload (2 bytes, little endian)
+# 's' followed by the sample interval in ms (uint32, little endian) starts
+# the stream and 'x' stops it.
+STREAM_SYNC = b'\xaa\x55'
+STREAM_START_CMD = b's'
+STREAM_STOP_CMD = b'x'
+STREAM_MAX_PAYLOAD = 64
+# consumed bytes are dropped from the decoder buffer once there are this many
+STREAM_COMPACT_SIZE = 4096
+
+# samples kept for the consumer before the oldest are overwritten
+SAMPLE_BUFFER_CAPACITY = 8192
+
+# Channel of a frame layout: raw little-endian integer on the wire, multiplied
+# by scale when decoded
+class FrameField:
+	CTYPES = {'<u1': ctypes.c_ubyte, '<u2': ctypes.c_ushort, '<i2': ctypes.c_short,
+			'<u4': ctypes.c_uint32, '<i4': ctypes.c_int32}
+	STRUCT_CODES = {'<u1': 'B', '<u2': 'H', '<i2': 'h', '<u4': 'I', '<i4': 'i'}
+			
+	def __init__(self, name, wire_type, scale=1.0):
+		self.name = name
+		self.wire_type = wire_type
+		self.scale = scale
+		
+# Declarative layout of one frame type
+# Every payload starts with the frame type byte and a msgId, followed by the
+# channels. The layout maps to a packed NumPy dtype, so a run of frames
+# decodes with one frombuffer call, and to a ctypes structure.
+class FrameSchema:
+	HEADER = [FrameField('type', '<u1'), FrameField('msgId', '<u2')]
+	
+	def __init__(self, name, type_id, fields):
+		self.name = name
+		self.type_id = type_id
+		self.fields = fields
+		self.dtype = np.dtype([(field.name, field.wire_type) for field in self.HEADER + fields])
+		self.itemsize = self.dtype.itemsize
+		# for decoding a lone frame, where NumPy's per-call overhead dominates
+		self.struct = struct.Struct('<' + ''.join(FrameField.STRUCT_CODES[field.wire_type] for field in self.HEADER + fields))
+		
+	def ctypes_struct(self):
+		return type(self.name, (ctypes.Structure,), {'_pack_': 1,
+			'_fields_': [(field.name, FrameField.CTYPES[field.wire_type]) for field in self.HEADER + self.fields]})
+			
+	def decode(self, buffer):
+		return np.frombuffer(buffer, dtype=self.dtype)
+
+# Temperatures in hundredths of a degree; this is also the reply to a 't' poll
+TEMPERATURE_SCHEMA = FrameSchema('SerialDataMsg', 1, [FrameField('thermocoupleTemp', '<i2', 0.01),
+													FrameField('gasTemp', '<i2', 0.01),
+													FrameField('outletTemp', '<i2', 0.01)])
+# Pressure in Pa, decoded to kPa
+PRESSURE_SCHEMA = FrameSchema('PressureDataMsg', 2, [FrameField('pressure', '<i4', 0.001)])
+
+# Streamed frames are decoded by their type byte
+FRAME_SCHEMAS = [TEMPERATURE_SCHEMA, PRESSURE_SCHEMA]
+
+SCHEMAS_BY_TYPE = {schema.type_id: schema for schema in FRAME_SCHEMAS}
+
+# session file records hold a payload of any schema
+RECORD_PAYLOAD_SIZE = max(schema.itemsize for schema in FRAME_SCHEMAS)
+
+# Row format of the poll data queue: the frame header, every channel of every
+# schema scaled to degrees or kPa (NaN where the frame type lacks it) and the
+# timestamp in seconds since polling started
+SAMPLE_CHANNELS = [field.name for schema in FRAME_SCHEMAS for field in schema.fields]
+SAMPLE_DTYPE = np.dtype([('timestamp', np.float64), ('type', np.uint8), ('msgId', np.uint16)] +
+						[(channel, np.float32) for channel in SAMPLE_CHANNELS])
+# a row with no channels set
+EMPTY_SAMPLE = np.array(tuple([0, 0, 0] + [np.nan] * len(SAMPLE_CHANNELS)), dtype=SAMPLE_DTYPE)
+# Row format of ArduinoManager's queue: a SAMPLE_DTYPE row tagged with the
+# index of the device it came from in ArduinoManager.device_names
+DEVICE_SAMPLE_DTYPE = np.dtype([('device', np.uint16)] + SAMPLE_DTYPE.descr)
+# position of each channel in a SAMPLE_DTYPE row
+SAMPLE_SLOTS = {channel: index + 3 for index, channel in enumerate(SAMPLE_CHANNELS)}
+
+# Decodes a single payload, see decode_frames
+def decode_frame(payload, timestamp, schema=None):
+	schema = schema or SCHEMAS_BY_TYPE.get(payload[0])
+	if not schema or len(payload) != schema.itemsize:
+		return np.empty(0, dtype=SAMPLE_DTYPE)
+	values = schema.struct.unpack(payload)
+	row = [timestamp, schema.type_id, values[1]] + [np.nan] * len(SAMPLE_CHANNELS)
+	for field, value in zip(schema.fields, values[2:]):
+		row[SAMPLE_SLOTS[field.name]] = value * field.scale
+	return np.array([tuple(row)], dtype=SAMPLE_DTYPE)
+
+# Decodes a list of payloads into SAMPLE_DTYPE rows stamped with timestamp,
+# one time for them all or an array with one per payload
+# Payloads are decoded by their type byte, or all as the given schema, and
+# the rows take the type of the schema used. Payloads of unknown type or the wrong length are left out. The work per
+# call is a few NumPy operations per schema however many frames there are.
+def decode_frames(payloads, timestamp, schema=None):
+	if len(payloads) == 1:
+		return decode_frame(payloads[0], timestamp[0] if np.ndim(timestamp) else timestamp, schema)
+	data = b''.join(payloads)
+	samples = np.empty(len(payloads), dtype=SAMPLE_DTYPE)
+	samples[:] = EMPTY_SAMPLE
+	samples['timestamp'] = timestamp
+	# a run of frames in one layout, such as poll replies
+	if schema and len(data) == schema.itemsize * len(payloads):
+		fill_samples(samples, schema, schema.decode(data))
+		return samples
+	lengths = np.fromiter(map(len, payloads), dtype=np.intp, count=len(payloads))
+	offsets = np.zeros(len(payloads), dtype=np.intp)
+	np.cumsum(lengths[:-1], out=offsets[1:])
+	raw = np.frombuffer(data, dtype=np.uint8)
+	decoded = np.zeros(len(payloads), dtype=bool)
+	for frame_schema in [schema] if schema else FRAME_SCHEMAS:
+		mask = lengths == frame_schema.itemsize
+		if not schema:
+			mask &= raw[np.minimum(offsets, len(raw) - 1)] == frame_schema.type_id
+		if mask.all():
+			fill_samples(samples, frame_schema, frame_schema.decode(data))
+			return samples
+		if not mask.any():
+			continue
+		# gather the bytes of the matching frames into one contiguous block
+		frame_bytes = raw[offsets[mask][:, None] + np.arange(frame_schema.itemsize)]
+		frames = np.ascontiguousarray(frame_bytes).view(frame_schema.dtype).ravel()
+		fill_samples(samples, frame_schema, frames, mask)
+		decoded |= mask
+	return samples[decoded]
+	
+# Decodes the records of a SessionReader into SAMPLE_DTYPE rows stamped with
+# their host times, by the type byte each payload was recorded with
+def decode_records(records):
+	samples = np.empty(len(records), dtype=SAMPLE_DTYPE)
+	samples[:] = EMPTY_SAMPLE
+	samples['timestamp'] = records['hostTime']
+	payloads = records['payload']
+	decoded = np.zeros(len(records), dtype=bool)
+	for schema in FRAME_SCHEMAS:
+		mask = payloads[:, 0] == schema.type_id
+		if not mask.any():
+			continue
+		frames = np.ascontiguousarray(payloads[mask, :schema.itemsize]).view(schema.dtype).ravel()
+		fill_samples(samples, schema, frames, mask)
+		decoded |= mask
+	return samples[decoded]
+	
+# Copies decoded frames into the rows of samples selected by mask
+def fill_samples(samples, schema, frames, mask=slice(None)):
+	samples['type'][mask] = schema.type_id
+	samples['msgId'][mask] = frames['msgId']
+	for field in schema.fields:
+		samples[field.name][mask] = frames[field.name] * field.scale
+		
+# Fixed-capacity ring buffer of samples shared by a producer and a consumer thread
+# The storage is allocated once; read() hands back the unread rows as a
+# single array (a view unless they wrap around the end), so a batch costs
+# the same few Python operations however many samples it holds. When the
+# consumer falls behind, the oldest unread samples are overwritten.
+class SampleRingBuffer:
+	def __init__(self, capacity=SAMPLE_BUFFER_CAPACITY, dtype=SAMPLE_DTYPE):
+		self.capacity = capacity
+		self.samples = np.zeros(capacity, dtype=dtype)
+		self.lock = threading.Lock()
+		self.clear()
+		
+	def clear(self):
+		with self.lock:
+			# total samples written and read, the buffer positions are these modulo capacity
+			self.write_count = 0
+			self.read_count = 0
+			# samples overwritten before they were read, and how many times that started
+			self.dropped = 0
+			self.overflows = 0
+			self.samples_lost_since_read = 0
+			
+	def __len__(self):
+		return self.write_count - self.read_count
+		
+	# Adds an array of rows of the buffer's dtype
+	def push(self, rows):
+		count = len(rows)
+		# rows that would be overwritten within this push are dropped up front
+		skipped = max(0, count - self.capacity)
+		if skipped:
+			rows = rows[skipped:]
+			count = self.capacity
+		with self.lock:
+			if count == 1 and self.write_count - self.read_count < self.capacity:
+				self.samples[self.write_count % self.capacity] = rows[0]
+				self.write_count += 1
+				return
+			overwritten = max(0, self.write_count - self.read_count + count - self.capacity)
+			if overwritten + skipped:
+				if self.samples_lost_since_read == 0:
+					self.overflows += 1
+				self.read_count += overwritten
+				self.dropped += overwritten + skipped
+				self.samples_lost_since_read += overwritten + skipped
+			start = self.write_count % self.capacity
+			first = min(count, self.capacity - start)
+			self.samples[start:start + first] = rows[:first]
+			self.samples[:count - first] = rows[first:]
+			self.write_count += count
+			
+	# Returns the unread samples and marks them read
+	# A view stays valid until another capacity samples have been pushed
+	def read(self):
+		with self.lock:
+			start = self.read_count % self.capacity
+			end = start + (self.write_count - self.read_count)
+			self.read_count = self.write_count
+			self.samples_lost_since_read = 0
+			if end <= self.capacity:
+				return self.samples[start:end]
+			return np.concatenate((self.samples[start:], self.samples[:end - self.capacity]))
+			
+# Raised for a poll reply that can't be decoded
+class FrameError(Exception):
+	pass
+	
+class ChecksumError(FrameError):
+	pass
+	
+class ShortReadError(FrameError):
+	pass
+	
+class NakError(FrameError):
+	pass
+
+# Incremental decoder for the streaming protocol
+# Bytes are fed in as they arrive, in chunks of any size. Complete frames
+# are returned as payloads; on a bad length or checksum the decoder skips a
+# byte and searches for the next sync word, so a corrupt or dropped byte
+# costs one frame rather than the rest of the stream. Checksum failures are
+# counted in the given LoggerStats.
+class FrameDecoder:
+	def __init__(self, stats, max_payload=STREAM_MAX_PAYLOAD):
+		self.stats = stats
+		self.max_payload = max_payload
+		self.buffer = bytearray()
+		self.read_pos = 0
+		
+		self.frames_decoded = 0
+		self.bad_lengths = 0
+		self.bytes_skipped = 0
+		
+	def reset(self):
+		self.buffer = bytearray()
+		self.read_pos = 0
+		
+	# Adds received bytes, returning the payloads of any frames they complete
+	def feed(self, data):
+		buffer = self.buffer
+		buffer.extend(data)
+		pos = self.read_pos
+		payloads = []
+		while True:
+			sync_pos = buffer.find(STREAM_SYNC, pos)
+			if sync_pos < 0:
+				# keep a trailing byte that may be the start of the next sync word
+				new_pos = max(pos, len(buffer) - 1)
+				self.bytes_skipped += new_pos - pos
+				pos = new_pos
+				break
+			self.bytes_skipped += sync_pos - pos
+			pos = sync_pos
+			if len(buffer) - pos < 3:
+				break
+			payload_len = buffer[pos + 2]
+			if payload_len == 0 or payload_len > self.max_payload:
+				self.bad_lengths += 1
+				pos += 1
+				continue
+			frame_end = pos + 3 + payload_len + 2
+			if len(buffer) < frame_end:
+				break
+			checksum = buffer[frame_end - 2] | (buffer[frame_end - 1] << 8)
+			if crc16(buffer[pos + 2:frame_end - 2]) != checksum:
+				self.stats.crc_failure()
+				pos += 1
+				continue
+			payloads.append(bytes(buffer[pos + 3:frame_end - 2]))
+			self.frames_decoded += 1
+			pos = frame_end
+		if pos >= STREAM_COMPACT_SIZE:
+			del buffer[:pos]
+			pos = 0
+		self.read_pos = pos
+		return payloads
+		
+# Builds a streaming protocol frame around a payload
+def encode_frame(payload):
+	body = bytes([len(payload)]) + payload
+	return STREAM_SYNC + body + crc16(body).to_bytes(2, byteorder="little")
 
 # Prototype data logger running on an Arduino
 class ArduinoLogger:
 
-	class SerialDataMsg(ctypes.Structure):
-		_pack_ = 1
-		_fields_ = [('type', ctypes.c_ubyte),
-					('msgId', ctypes.c_ushort),
-					('thermocoupleTemp', ctypes.c_short),
-					('gasTemp', ctypes.c_short),
-					('outletTemp', ctypes.c_short)]
+	SerialDataMsg = TEMPERATURE_SCHEMA.ctypes_struct()
+	
+	# reply to a poll: ACK + checksum + struct
+	REPLY_LEN = 1 + ctypes.sizeof(ctypes.c_ushort) + ctypes.sizeof(SerialDataMsg)
+	
+	# Checks a poll reply and returns the SerialDataMsg it holds
+	@classmethod
+	def decode_reply(cls, bytes_read):
+		if len(bytes_read) < cls.REPLY_LEN:
+			raise ShortReadError('invalid response from arduino: {0}'.format(bytes(bytes_read)))
+		# check for ACK
+		if bytes_read[0] != ACK:
+			raise NakError('arduino response did not begin with ACK: {0}'.format(bytes(bytes_read)))
+		# read checksum
+		checksum = int.from_bytes(bytes_read[1:3], byteorder="little", signed=False)
+		# generate checksum of remaining data and reject corrupt frames
+		checksum_calced = crc16(bytes_read[3:cls.REPLY_LEN])
+		if checksum != checksum_calced:
+			raise ChecksumError('arduino response failed checksum ({0:04x} != {1:04x})'.format(checksum, checksum_calced))
+		return cls.SerialDataMsg.from_buffer_copy(bytes_read[3:cls.REPLY_LEN])
 
-	def __init__(self, port, update_interval_ms=1000):
+	# With streaming set, the device pushes samples continuously instead of
+	# being asked for each one (needs firmware support for the streaming protocol)
+	# With record_filename set, every sample is also recorded to that session
+	# file, or to a numbered name beside it if the file exists, so restarting
+	# the thread starts a new session instead of overwriting the last one
+	# With stats_filename set, get_stats() is written there every stats_interval seconds
+	def __init__(self, port, update_interval_ms=1000, streaming=False, record_filename=None,
+			stats_filename=None, stats_interval=5):
 		self.port = port
+		self.streaming = streaming
+		self.record_filename = record_filename
+		self.recorder = None
+		self.stats = LoggerStats()
+		self.stats_reporter = StatsReporter(self.get_stats, stats_filename, stats_interval) if stats_filename else None
 		self.main_thread = None
 		self.thread_lock = threading.Lock()
 		self.thread_started_cv = threading.Condition(self.thread_lock)
 		
 		self.update_interval_ms = update_interval_ms
-		self.last_poll_time = time.time()
+		# scheduling uses the monotonic clock so wall clock changes don't
+		# shift samples; polls target absolute deadlines to avoid drift
+		self.next_poll_time = 0
+		self.last_sample_time = None
 		self.polling_start_time = 0
 		self.setup_start_time = 0
+		# set to wake the thread when its state changes
+		self.wake_event = threading.Event()
 		
 		self.thread_running = False
 		self.thread_error = False
@@ -43,7 +428,12 @@ class ArduinoLogger:
 		self.setup_event = threading.Event()
 		self.arduino_setup_done = False
 		self.is_polling = False
-		self.poll_data_queue = []
+		self.poll_data_queue = SampleRingBuffer()
+		
+		self.frames_received = 0
+		
+		self.frame_decoder = FrameDecoder(self.stats)
+		self.stream_active = False
 		
 		self.serial_port_handle = None
 		
@@ -54,55 +444,188 @@ class ArduinoLogger:
 		self.thread_error_msg = ""
 		self.arduino_setup_done = False
 		self.is_polling = False
-		self.poll_data_queue = []
+		self.poll_data_queue.clear()
 		self.polling_start_time = 0
+		self.frames_received = 0
+		self.stats.reset()
+		self.last_sample_time = None
+		self.frame_decoder = FrameDecoder(self.stats)
+		self.stream_active = False
 		self.setup_event.clear()
+		self.wake_event.clear()
 		self.main_thread = threading.Thread(target=self.thread_main)
 		with self.thread_started_cv:
 			self.main_thread.start()
 			if not self.thread_started_cv.wait(5):
 				print("Failed to start the thread")
 				return False
+		if self.stats_reporter:
+			self.stats_reporter.start()
 		
 		return True
 		
 	def stop_thread(self):
 		self.thread_running = False
+		self.wake_event.set()
 		self.main_thread.join()
+		if self.stats_reporter:
+			self.stats_reporter.stop()
 		
 		self.main_thread = None
 		self.serial_port_handle = None
 		
 	def start_polling(self):
 		if self.polling_start_time == 0:
-			self.polling_start_time = time.time()
+			self.polling_start_time = time.monotonic()
+		self.next_poll_time = time.monotonic()
+		self.last_sample_time = None
 		self.is_polling = True
+		self.wake_event.set()
 	def stop_polling(self):
 		self.is_polling = False
+		self.wake_event.set()
 		
 	def thread_fail(self, message):
 		self.thread_error = True
 		self.thread_error_msg = message
 		self.thread_running = False
 		
+	# Returns the sample timing statistics, in seconds
+	def get_timing_stats(self):
+		return self.stats.timing_snapshot()
+		
+	# Returns the link health statistics: poll and frame error counts, msgId
+	# gaps, round trip and sample timing, achieved against requested sample
+	# rate and the state of the poll data queue
+	def get_stats(self):
+		stats = self.stats.snapshot()
+		stats["requested_rate"] = 1000 / self.update_interval_ms if self.update_interval_ms > 0 else None
+		stats["queue_depth"] = len(self.poll_data_queue)
+		stats["queue_capacity"] = self.poll_data_queue.capacity
+		stats["queue_dropped"] = self.poll_data_queue.dropped
+		stats["queue_overflows"] = self.poll_data_queue.overflows
+		stats["stream"] = {"frames_decoded": self.frame_decoder.frames_decoded,
+						"bad_lengths": self.frame_decoder.bad_lengths,
+						"bytes_skipped": self.frame_decoder.bytes_skipped}
+		return stats
+		
 	def crc16_update(self, crc, a):
-		crc ^= a
-		for i in range(0, 8):
-			if crc & 1:
-				crc = (crc >> 1) ^ 0xA001
-			else:
-				crc = (crc >> 1)
-		return crc
+		return (crc >> 8) ^ CRC16_TABLE[(crc ^ a) & 0xFF]
+		
+	# Adds a decoded sample to the poll data queue
+	# Frames received together are decoded and queued in one go
+	def queue_frames(self, payloads, schema=None):
+		sample_time = time.monotonic()
+		# frames read together were sent an interval apart, so rather than
+		# sharing the read time each is stamped an interval before the next
+		frame_times = sample_time
+		if len(payloads) > 1:
+			frame_times = sample_time - np.arange(len(payloads) - 1, -1, -1) * (self.update_interval_ms / 1000)
+		samples = decode_frames(payloads, frame_times - self.polling_start_time, schema)
+		if len(samples) < len(payloads):
+			self.stats.unknown_frame(len(payloads) - len(samples))
+		if not len(samples):
+			return
+		if self.last_sample_time is not None:
+			self.stats.observe_sample_jitter(sample_time - self.last_sample_time - len(samples) * self.update_interval_ms / 1000)
+		self.last_sample_time = sample_time
+		self.stats.sample(samples['msgId'], sample_time)
+		if self.recorder:
+			for index, payload in enumerate(payloads):
+				frame_schema = schema or SCHEMAS_BY_TYPE.get(payload[0])
+				if frame_schema and len(payload) == frame_schema.itemsize:
+					# recorded with the type the row was decoded as, so the
+					# session reads back the same way
+					self.recorder.write(bytes([frame_schema.type_id]) + payload[1:],
+						sample_time if len(payloads) == 1 else float(frame_times[index]))
+		self.poll_data_queue.push(samples)
+		
+	def start_stream(self):
+		self.serial_port_handle.reset_input_buffer()
+		self.frame_decoder.reset()
+		self.serial_port_handle.write(STREAM_START_CMD + struct.pack('<I', int(self.update_interval_ms)))
+		self.stream_active = True
+		
+	def stop_stream(self):
+		self.serial_port_handle.write(STREAM_STOP_CMD)
+		self.stream_active = False
 		
-	# Returns thread-safe copy of queues data
-	# and clears the queue
+	# Reads whatever the device has pushed and queues the complete frames
+	def read_stream(self):
+		incoming_data = self.serial_port_handle.read(max(1, self.serial_port_handle.in_waiting))
+		payloads = self.frame_decoder.feed(incoming_data)
+		if payloads:
+			self.frames_received += len(payloads)
+			self.queue_frames(payloads)
+		
+	# Returns the samples queued since the last call as a SAMPLE_DTYPE array
 	def get_queued_data(self):
-		self.thread_lock.acquire()
-		data_queue_copy = self.poll_data_queue.copy()
-		self.poll_data_queue = []
-		self.thread_lock.release()
-		return data_queue_copy
+		return self.poll_data_queue.read()
+		
+	# Requests a sample from the Arduino and queues the reply
+	def poll_sample(self):
+		self.serial_port_handle.reset_input_buffer()
+		request_time = time.monotonic()
+		self.serial_port_handle.write('t'.encode('utf-8'))
+		self.stats.poll_sent()
+		bytes_read = self.serial_port_handle.read(self.REPLY_LEN)
+		if len(bytes_read) == self.REPLY_LEN:
+			self.stats.observe_rtt(time.monotonic() - request_time)
+		try:
+			self.decode_reply(bytes_read)
+		except ChecksumError as e:
+			self.stats.crc_failure()
+			print(e)
+			return
+		except ShortReadError as e:
+			self.stats.short_read()
+			print(e)
+			return
+		except NakError as e:
+			self.stats.nak()
+			print(e)
+			return
+		self.frames_received += 1
+		# replies always use the temperature layout, whatever their type byte
+		self.queue_frames([bytes_read[3:self.REPLY_LEN]], TEMPERATURE_SCHEMA)
 		
+	# Polls if the next deadline has passed, otherwise sleeps until it does
+	# or the thread is woken
+	def run_poll_schedule(self):
+		now = time.monotonic()
+		if now < self.next_poll_time:
+			self.wake_event.wait(self.next_poll_time - now)
+			return
+		self.stats.observe_poll_lateness(now - self.next_poll_time)
+		self.poll_sample()
+		# the next deadline follows from the last one, not from when the
+		# poll finished, so the schedule doesn't drift
+		interval = self.update_interval_ms / 1000
+		self.next_poll_time += interval
+		now = time.monotonic()
+		# an interval of 0 polls as fast as the Arduino replies
+		if interval <= 0:
+			self.next_poll_time = now
+		elif now - self.next_poll_time > MAX_POLL_LATENESS_MS / 1000:
+			missed = math.ceil((now - self.next_poll_time) / interval)
+			self.stats.missed_poll(missed)
+			self.next_poll_time += missed * interval
+			
+	# Reads whatever setup output has arrived, blocking for up to SERIAL_TIMEOUT
+	def read_setup(self, data_buffer):
+		incoming_data = self.serial_port_handle.read(max(1, self.serial_port_handle.in_waiting))
+		data_buffer.extend(incoming_data)
+		if b"SETUP DONE!" in data_buffer:
+			self.arduino_setup_done = True
+			self.setup_event.set()
+			print("Arduino finished setup")
+			return
+		# only the tail can still hold part of the message
+		del data_buffer[:-16]
+		# Check if timed out setup
+		if time.monotonic() - self.setup_start_time > SETUP_TIMEOUT:
+			self.thread_fail('Arduino failed to setup or did not respond')
+			
 	def thread_main(self):
 		print('poll thread enter')
 		self.thread_running = True
@@ -119,68 +642,514 @@ class ArduinoLogger:
 		except serial.SerialException as e:
 			self.thread_fail(e)
 			return
+		if self.record_filename:
+			try:
+				self.recorder = SessionRecorder(unused_filename(self.record_filename), RECORD_PAYLOAD_SIZE)
+				print('Recording session to {0}'.format(self.recorder.filename))
+			except OSError as e:
+				self.serial_port_handle.close()
+				self.thread_fail(e)
+				return
 		
-		self.setup_start_time = time.time()
+		self.setup_start_time = time.monotonic()
 		data_buffer = bytearray()
 		
 		print('Waiting for arduino to finish setup...')
 		
+		# Every branch blocks on the serial port or the wake event, so the
+		# thread only runs when there is something to do
+		try:
+			while self.thread_running:
+				# cleared before the state is checked so a change made after
+				# this point still ends the wait below
+				self.wake_event.clear()
+				try:
+					# wait for "SETUP DONE"
+					if not self.arduino_setup_done:
+						self.read_setup(data_buffer)
+					# if Arduino has finished setup and pushes samples itself
+					elif self.streaming:
+						if self.is_polling and not self.stream_active:
+							self.start_stream()
+						elif not self.is_polling and self.stream_active:
+							self.stop_stream()
+						if self.stream_active:
+							self.read_stream()
+						else:
+							self.wake_event.wait()
+					# if Arduino has finished setup
+					elif self.is_polling:
+						self.run_poll_schedule()
+					else:
+						self.wake_event.wait()
+				# a port that goes away fails with EIO from in_waiting, an OSError
+				except PORT_ERRORS as e:
+					self.thread_fail(e)
+		finally:
+			if self.stream_active:
+				try:
+					self.stop_stream()
+				except PORT_ERRORS:
+					pass
+			try:
+				self.serial_port_handle.close()
+			except PORT_ERRORS:
+				pass
+			if self.recorder:
+				self.recorder.close()
+				self.recorder = None
+		print('poll thread exit')
+
+# Serial port of one board driven by an ArduinoManager
+class ArduinoDevice:
+	def __init__(self, name, port, index):
+		self.name = name
+		self.port = port
+		# tag of the device's rows in the manager's queue
+		self.index = index
+		self.reset()
+		
+	# Returns to the unopened state, so a restarted manager opens the port
+	# and waits for setup again
+	def reset(self):
+		self.serial_port_handle = None
+		self.setup_done = False
+		self.setup_start_time = 0
+		self.setup_buffer = bytearray()
+		# reply to the current tick's poll
+		self.awaiting_reply = False
+		self.reply_buffer = bytearray()
+		
+		self.frames_received = 0
+		self.crc_failures = 0
+		self.missed_replies = 0
+		self.error = False
+		self.error_msg = ""
+		
+	def open(self):
+		self.serial_port_handle = serial.Serial()
+		self.serial_port_handle.port = self.port
+		self.serial_port_handle.baudrate = ARDUINO_BAUD_RATE
+		# reads only return what has already arrived, the manager waits for data
+		self.serial_port_handle.timeout = 0
+		self.serial_port_handle.write_timeout = SERIAL_TIMEOUT
+		self.serial_port_handle.setDTR(False)
+		self.serial_port_handle.open()
+		self.setup_start_time = time.monotonic()
+		
+	def close(self):
+		if self.serial_port_handle:
+			self.serial_port_handle.close()
+			
+	def fileno(self):
+		return self.serial_port_handle.fileno()
+		
+# Drives several Arduino loggers from one thread
+# Every port is registered with a selector, so the thread sleeps until one
+# of them has data or the next tick is due. Each board runs its setup
+# handshake on its own; once polling, every ready board is asked for a
+# sample on the same monotonic tick, and the samples go into one queue
+# tagged with the device and stamped with the tick's timestamp, so they line
+# up across boards and come out in tick order.
+# Needs ports the selector can wait on (POSIX serial ports).
+class ArduinoManager:
+	def __init__(self, update_interval_ms=1000):
+		self.update_interval_ms = update_interval_ms
+		self.devices = {}
+		self.main_thread = None
+		self.thread_lock = threading.Lock()
+		
+		self.thread_running = False
+		self.is_polling = False
+		self.polling_start_time = 0
+		self.next_tick_time = 0
+		self.tick_time = 0
+		self.missed_ticks = 0
+		# names of the devices by the index their rows are tagged with
+		self.device_names = []
+		self.poll_data_queue = SampleRingBuffer(dtype=DEVICE_SAMPLE_DTYPE)
+		
+		self.selector = None
+		self.wake_receiver = None
+		self.wake_sender = None
+		
+	# Adds a board, which is opened by the manager thread
+	def add_device(self, name, port):
+		with self.thread_lock:
+			if name not in self.device_names:
+				self.device_names.append(name)
+			self.devices[name] = ArduinoDevice(name, port, self.device_names.index(name))
+		self.wake()
+		
+	def setup_done(self):
+		with self.thread_lock:
+			return bool(self.devices) and all(device.setup_done or device.error for device in self.devices.values())
+		
+	def start_thread(self):
+		self.selector = selectors.DefaultSelector()
+		# writing to this socket pair wakes the selector when state changes
+		self.wake_receiver, self.wake_sender = socket.socketpair()
+		self.wake_receiver.setblocking(False)
+		self.selector.register(self.wake_receiver, selectors.EVENT_READ, None)
+		for device in self.device_list():
+			device.reset()
+		self.poll_data_queue.clear()
+		self.thread_running = True
+		self.main_thread = threading.Thread(target=self.thread_main)
+		self.main_thread.start()
+		
+	def stop_thread(self):
+		self.thread_running = False
+		self.wake()
+		self.main_thread.join()
+		self.main_thread = None
+		
+	def start_polling(self):
+		if self.polling_start_time == 0:
+			self.polling_start_time = time.monotonic()
+		self.next_tick_time = time.monotonic()
+		self.is_polling = True
+		self.wake()
+	def stop_polling(self):
+		self.is_polling = False
+		self.wake()
+		
+	def wake(self):
+		if self.wake_sender:
+			try:
+				self.wake_sender.send(b'\0')
+			except BlockingIOError:
+				pass
+				
+	# Returns the samples queued since the last call as a DEVICE_SAMPLE_DTYPE
+	# array in tick order; device_names maps the device column to names
+	def get_queued_data(self):
+		return self.poll_data_queue.read()
+		
+	def device_fail(self, device, message):
+		print('Arduino {0} on {1} failed: {2}'.format(device.name, device.port, message))
+		device.error = True
+		device.error_msg = message
+		if device.serial_port_handle and device.serial_port_handle.is_open:
+			self.selector.unregister(device)
+			try:
+				device.close()
+			except PORT_ERRORS:
+				pass
+			
+	# Snapshot of the devices, add_device may change the dict from another thread
+	def device_list(self):
+		with self.thread_lock:
+			return list(self.devices.values())
+			
+	def open_new_devices(self):
+		new_devices = [device for device in self.device_list() if device.serial_port_handle is None and not device.error]
+		for device in new_devices:
+			try:
+				device.open()
+			except serial.SerialException as e:
+				device.error = True
+				device.error_msg = e
+				continue
+			self.selector.register(device, selectors.EVENT_READ, device)
+			print('Waiting for arduino {0} to finish setup...'.format(device.name))
+			
+	def read_device(self, device):
+		incoming_data = device.serial_port_handle.read(device.serial_port_handle.in_waiting or 1)
+		if not device.setup_done:
+			device.setup_buffer.extend(incoming_data)
+			if b"SETUP DONE!" in device.setup_buffer:
+				device.setup_done = True
+				device.setup_buffer = bytearray()
+				print("Arduino {0} finished setup".format(device.name))
+			else:
+				del device.setup_buffer[:-16]
+			return
+		# anything arriving outside a poll is noise
+		if not device.awaiting_reply:
+			return
+		device.reply_buffer.extend(incoming_data)
+		if len(device.reply_buffer) < ArduinoLogger.REPLY_LEN:
+			return
+		device.awaiting_reply = False
+		try:
+			ArduinoLogger.decode_reply(device.reply_buffer)
+		except ChecksumError as e:
+			device.crc_failures += 1
+			print('{0}: {1}'.format(device.name, e))
+			return
+		except FrameError as e:
+			print('{0}: {1}'.format(device.name, e))
+			return
+		device.frames_received += 1
+		sample = decode_frame(device.reply_buffer[3:ArduinoLogger.REPLY_LEN],
+			self.tick_time - self.polling_start_time, TEMPERATURE_SCHEMA)
+		self.poll_data_queue.push(np.array([(device.index,) + sample[0].item()], dtype=DEVICE_SAMPLE_DTYPE))
+			
+	# Sends a poll to every ready board
+	def start_tick(self):
+		self.tick_time = self.next_tick_time
+		for device in self.device_list():
+			if not device.setup_done or device.error:
+				continue
+			if device.awaiting_reply:
+				device.missed_replies += 1
+			device.awaiting_reply = True
+			device.reply_buffer = bytearray()
+			try:
+				device.serial_port_handle.reset_input_buffer()
+				device.serial_port_handle.write(b't')
+			except PORT_ERRORS as e:
+				self.device_fail(device, e)
+		interval = self.update_interval_ms / 1000
+		self.next_tick_time += interval
+		now = time.monotonic()
+		if interval <= 0:
+			self.next_tick_time = now
+		elif now > self.next_tick_time:
+			missed = math.ceil((now - self.next_tick_time) / interval)
+			self.missed_ticks += missed
+			self.next_tick_time += missed * interval
+			
+	def check_setup_timeouts(self):
+		now = time.monotonic()
+		for device in self.device_list():
+			if device.serial_port_handle and not device.setup_done and not device.error:
+				if now - device.setup_start_time > SETUP_TIMEOUT:
+					self.device_fail(device, 'Arduino failed to setup or did not respond')
+					
+	# Time to wait in select before the thread needs to act anyway
+	def select_timeout(self):
+		timeout = None
+		if any(not device.setup_done and not device.error for device in self.device_list()):
+			timeout = SERIAL_TIMEOUT
+		if self.is_polling:
+			tick_timeout = max(0, self.next_tick_time - time.monotonic())
+			timeout = tick_timeout if timeout is None else min(timeout, tick_timeout)
+		return timeout
+		
+	def thread_main(self):
+		print('manager thread enter')
 		while self.thread_running:
-			# if Arduino has finished setup
-			if self.arduino_setup_done and self.is_polling:
-				if ((time.time() - self.last_poll_time) * 1000) > self.update_interval_ms:
+			self.open_new_devices()
+			for key, events in self.selector.select(self.select_timeout()):
+				if key.data is None:
 					try:
-						self.serial_port_handle.flushInput()
-						self.serial_port_handle.flushOutput()
-						self.serial_port_handle.write('t'.encode('utf-8'))
-						# Try to read bytes
-						# read struct len + checksum + ACK
-						data_len = ctypes.sizeof(self.SerialDataMsg) + ctypes.sizeof(ctypes.c_ushort) + 1
-						bytes_read = self.serial_port_handle.read(data_len)
-						if len(bytes_read) < data_len:
-							print('invalid response from arduino: {0}'.format(bytes_read))
-							continue
-						# check for ACK
-						if bytes_read[0] != 0x06:
-							print('arduino response did not begin with ACK')
-							print(bytes_read)
-						# read checksum
-						checksum = int.from_bytes(bytes_read[1:3], byteorder="little", signed=False)
-						# generate checksum of remaining data
-						checksum_calced = 0
-						for byte in bytes_read[3:]:
-							checksum_calced = self.crc16_update(checksum_calced, byte)
-						data_struct = self.SerialDataMsg.from_buffer_copy(bytes_read[3:])
-						# Format data for poll data queue
-						# Format:
-						#	gasTemp
-						#	outletTemp
-						#	timestamp
-						data_block = [data_struct.gasTemp / 100, data_struct.outletTemp / 100, time.time() - self.polling_start_time]
-						self.thread_lock.acquire()
-						self.poll_data_queue.append(data_block)
-						self.thread_lock.release()
-					except serial.SerialException as e:
-						self.thread_fail(e)
-						continue
-					self.last_poll_time = time.time()
-			# wait for "SETUP DONE"
-			elif not self.arduino_setup_done:
-				incoming_data = self.serial_port_handle.read(1)
-				data_buffer.extend(incoming_data)
-				#data_buffer.append(incoming_data)
-				if len(data_buffer) > 10:
-					if "SETUP DONE!" in data_buffer.decode():
-						self.arduino_setup_done = True
-						self.setup_event.set()
-						print("Arduino finished setup")
-						
-				# Check if timed out setup
-				if time.time() - self.setup_start_time > SETUP_TIMEOUT:
-					self.thread_fail('Arduino failed to setup or did not respond')
+						self.wake_receiver.recv(4096)
+					except BlockingIOError:
+						pass
 					continue
+				# a port that goes away fails with EIO from in_waiting, an OSError
+				try:
+					self.read_device(key.data)
+				except PORT_ERRORS as e:
+					self.device_fail(key.data, e)
+			self.check_setup_timeouts()
+			if self.is_polling and time.monotonic() >= self.next_tick_time:
+				self.start_tick()
+				
+		for device in self.device_list():
+			try:
+				device.close()
+			except PORT_ERRORS:
+				pass
+		self.selector.close()
+		self.wake_receiver.close()
+		self.wake_sender.close()
+		self.wake_sender = None
+		print('manager thread exit')
+
+# asyncio counterpart of ArduinoLogger
+# The serial port is watched with loop.add_reader instead of a thread, and
+# samples are delivered through a bounded asyncio.Queue: when the consumer
+# falls behind, polling waits for room rather than queueing without limit.
+# Each sample is a SAMPLE_DTYPE row, as in ArduinoLogger's poll data queue.
+# Needs a selectable serial port (POSIX).
+#
+#	async with AsyncArduinoLogger(port, 500) as logger:
+#		await logger.start_polling()
+#		async for sample in logger:
+#			...
+class AsyncArduinoLogger:
+	def __init__(self, port, update_interval_ms=1000, max_queued=256):
+		self.port = port
+		self.update_interval_ms = update_interval_ms
+		self.max_queued = max_queued
+		
+		self.serial_port_handle = None
+		self.reader = None
+		self.reader_fd = None
+		self.queue = None
+		self.poll_task = None
+		self.closed_event = None
+		self.polling_start_time = 0
+		# what stopped the logger, raised to the consumer once the queue is drained
+		self.error = None
+		
+		self.arduino_setup_done = False
+		self.frames_received = 0
+		self.crc_failures = 0
+		self.reply_timeouts = 0
+		
+	async def __aenter__(self):
+		await self.connect()
+		return self
+		
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.close()
+		
+	def __aiter__(self):
+		return self
+		
+	# Returns the next sample, ending once the logger is closed and drained
+	# If the port failed, the error is raised instead of ending
+	async def __anext__(self):
+		if not self.queue.empty():
+			return self.queue.get_nowait()
+		if self.closed_event.is_set():
+			if self.error:
+				raise self.error
+			raise StopAsyncIteration
+		get_task = asyncio.ensure_future(self.queue.get())
+		closed_task = asyncio.ensure_future(self.closed_event.wait())
+		try:
+			await asyncio.wait([get_task, closed_task], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			closed_task.cancel()
+			if not get_task.done():
+				get_task.cancel()
+		if get_task.done() and not get_task.cancelled():
+			return get_task.result()
+		if self.error:
+			raise self.error
+		raise StopAsyncIteration
+		
+	# Feeds bytes that arrived on the port to the current reader
+	def on_readable(self):
+		try:
+			incoming_data = self.serial_port_handle.read(self.serial_port_handle.in_waiting or 1)
+		except PORT_ERRORS as e:
+			# the port is gone, so stop watching it rather than failing on every loop iteration
+			self.fail(e)
+			return
+		self.reader.feed_data(incoming_data)
+		
+	def stop_reading(self):
+		if self.reader_fd is not None:
+			asyncio.get_running_loop().remove_reader(self.reader_fd)
+			self.reader_fd = None
 			
-			time.sleep(INTERNAL_UPDATE_RATE_MS / 1000)
+	# Stops the logger after a port error, waking anything waiting on it
+	def fail(self, error):
+		if self.error is None:
+			print('Arduino logger on {0} failed: {1}'.format(self.port, error))
+			self.error = error
+		self.stop_reading()
+		self.reader.set_exception(error)
+		self.closed_event.set()
+		
+	# Opens the port and waits for the Arduino to finish setup
+	async def connect(self):
+		loop = asyncio.get_running_loop()
+		self.queue = asyncio.Queue(self.max_queued)
+		self.closed_event = asyncio.Event()
+		self.serial_port_handle = serial.Serial()
+		self.serial_port_handle.port = self.port
+		self.serial_port_handle.baudrate = ARDUINO_BAUD_RATE
+		self.serial_port_handle.timeout = 0
+		self.serial_port_handle.write_timeout = SERIAL_TIMEOUT
+		self.serial_port_handle.setDTR(False)
+		self.serial_port_handle.open()
+		self.reader = asyncio.StreamReader()
+		self.reader_fd = self.serial_port_handle.fileno()
+		loop.add_reader(self.reader_fd, self.on_readable)
+		try:
+			await asyncio.wait_for(self.reader.readuntil(b"SETUP DONE!"), SETUP_TIMEOUT)
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+			await self.close()
+			raise serial.SerialException('Arduino failed to setup or did not respond')
+		self.arduino_setup_done = True
+		
+	async def close(self):
+		await self.stop_polling()
+		self.stop_reading()
+		if self.serial_port_handle and self.serial_port_handle.is_open:
+			try:
+				self.serial_port_handle.close()
+			except PORT_ERRORS:
+				pass
+		if self.closed_event:
+			self.closed_event.set()
+			
+	async def start_polling(self):
+		if self.poll_task:
+			return
+		loop = asyncio.get_running_loop()
+		if self.polling_start_time == 0:
+			self.polling_start_time = loop.time()
+		self.poll_task = loop.create_task(self.poll_main())
+		
+	async def stop_polling(self):
+		if not self.poll_task:
+			return
+		self.poll_task.cancel()
+		try:
+			await self.poll_task
+		except asyncio.CancelledError:
+			pass
+		self.poll_task = None
+		
+	# Requests a sample and returns it as a SAMPLE_DTYPE row, or None if
+	# the reply was missing or corrupt
+	async def poll_sample(self):
+		# a fresh reader drops anything left over from earlier polls
+		self.serial_port_handle.reset_input_buffer()
+		self.reader = asyncio.StreamReader()
+		self.serial_port_handle.write(b't')
+		try:
+			bytes_read = await asyncio.wait_for(self.reader.readexactly(ArduinoLogger.REPLY_LEN), SERIAL_TIMEOUT)
+		except asyncio.TimeoutError:
+			self.reply_timeouts += 1
+			print('no response from arduino')
+			return None
+		try:
+			ArduinoLogger.decode_reply(bytes_read)
+		except ChecksumError as e:
+			self.crc_failures += 1
+			print(e)
+			return None
+		except FrameError as e:
+			print(e)
+			return None
+		self.frames_received += 1
+		timestamp = asyncio.get_running_loop().time() - self.polling_start_time
+		return decode_frame(bytes_read[3:ArduinoLogger.REPLY_LEN], timestamp, TEMPERATURE_SCHEMA)[0]
+		
+	# Runs the poll loop, stopping the logger if the port fails
+	async def poll_main(self):
+		try:
+			await self.poll_loop()
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			self.fail(e)
 			
-		self.serial_port_handle.close()
-		print('poll thread exit')
\ No newline at end of file
+	# Polls on absolute deadlines of the loop's monotonic clock
+	async def poll_loop(self):
+		loop = asyncio.get_running_loop()
+		next_poll_time = loop.time()
+		while True:
+			delay = next_poll_time - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			sample = await self.poll_sample()
+			if sample is not None:
+				# waits while the queue is full
+				await self.queue.put(sample)
+			interval = self.update_interval_ms / 1000
+			next_poll_time += interval
+			# skip the slots missed while waiting on the consumer
+			if interval <= 0:
+				next_poll_time = loop.time()
+			elif loop.time() - next_poll_time > MAX_POLL_LATENESS_MS / 1000:
+				next_poll_time += math.ceil((loop.time() - next_poll_time) / interval) * interval
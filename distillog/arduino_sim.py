@@ -0,0 +1,149 @@
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from arduino_proto import ArduinoLogger, ACK, STREAM_START_CMD, STREAM_STOP_CMD, crc16, encode_frame
+
+# Simulated Arduino data logger on a pseudo-terminal
+# Emulates the firmware well enough to run ArduinoLogger without a board:
+# it prints the "SETUP DONE!" banner, answers 't' with ACK + CRC16 +
+# SerialDataMsg and handles the streaming protocol start and stop commands.
+# Replies can be delayed, corrupted or dropped to exercise error handling.
+#
+#	simulator = ArduinoSimulator(waveform="sine", corrupt_rate=0.01)
+#	simulator.start()
+#	logger = ArduinoLogger(simulator.port)
+#
+# Like a real board, the simulator waits setup_delay seconds after start()
+# before printing the banner, so start it just after the logger thread.
+
+# Temperatures in degrees for each waveform as a function of time in seconds
+# Returns (thermocouple, gas, outlet)
+WAVEFORMS = {
+	"constant": lambda t: (250.0, 180.0, 75.0),
+	"sine": lambda t: (250.0 + 50 * math.sin(t / 5), 180.0 + 20 * math.sin(t / 10), 75.0 + 5 * math.sin(t / 20)),
+	"ramp": lambda t: (70.0 + 2 * t, 70.0 + t, 70.0 + 0.25 * t),
+	"noise": lambda t: (250.0 + random.gauss(0, 2), 180.0 + random.gauss(0, 1), 75.0 + random.gauss(0, 0.5)),
+}
+
+# SerialDataMsg holds hundredths of a degree in an int16, so temperatures
+# beyond this saturate, as the ramp does after a couple of minutes
+MAX_TEMPERATURE = 327.67
+
+def to_hundredths(temperature):
+	return round(max(-MAX_TEMPERATURE, min(MAX_TEMPERATURE, temperature)) * 100)
+
+class ArduinoSimulator:
+	def __init__(self, waveform="sine", response_delay_ms=0, corrupt_rate=0.0, drop_rate=0.0, setup_delay=0.5, seed=None):
+		self.waveform = WAVEFORMS[waveform]
+		self.response_delay_ms = response_delay_ms
+		self.corrupt_rate = corrupt_rate
+		self.drop_rate = drop_rate
+		self.setup_delay = setup_delay
+		self.random = random.Random(seed)
+
+		self.master_fd = None
+		self.slave_fd = None
+		self.port = None
+		self.thread = None
+		self.running = False
+		self.start_time = 0
+
+		# messages built so far; the msgId is this modulo 2**16
+		self.message_count = 0
+		self.stream_interval = None
+		self.next_stream_time = 0
+		# monotonic time each message was sent, NaN if dropped, by message
+		# number (so unaffected by msgId wrapping), for latency measurements
+		self.sent_times = []
+		self.requests = 0
+		self.replies_sent = 0
+		self.replies_corrupted = 0
+		self.replies_dropped = 0
+
+	def start(self):
+		self.master_fd, self.slave_fd = os.openpty()
+		tty.setraw(self.slave_fd)
+		self.port = os.ttyname(self.slave_fd)
+		self.start_time = time.monotonic()
+		self.running = True
+		self.thread = threading.Thread(target=self.thread_main, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		os.close(self.master_fd)
+		os.close(self.slave_fd)
+
+	# Builds the next SerialDataMsg from the waveform
+	def next_payload(self):
+		thermocouple_temp, gas_temp, outlet_temp = self.waveform(time.monotonic() - self.start_time)
+		data_struct = ArduinoLogger.SerialDataMsg(1, self.message_count & 0xFFFF, to_hundredths(thermocouple_temp),
+			to_hundredths(gas_temp), to_hundredths(outlet_temp))
+		self.message_count += 1
+		return bytes(data_struct)
+
+	# Writes the reply or frame holding the latest payload, applying the
+	# configured drops and corruption
+	def send(self, frame):
+		if self.random.random() < self.drop_rate:
+			self.replies_dropped += 1
+			self.sent_times.append(math.nan)
+			return
+		if self.random.random() < self.corrupt_rate:
+			frame = bytearray(frame)
+			frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+			self.replies_corrupted += 1
+		self.sent_times.append(time.monotonic())
+		os.write(self.master_fd, frame)
+		self.replies_sent += 1
+
+	def reply(self):
+		if self.response_delay_ms:
+			time.sleep(self.response_delay_ms / 1000)
+		payload = self.next_payload()
+		self.send(bytes([ACK]) + crc16(payload).to_bytes(2, byteorder="little") + payload)
+
+	def handle_commands(self, data):
+		while data:
+			command = data[:1]
+			if command == b't':
+				self.requests += 1
+				self.reply()
+				data = data[1:]
+			elif command == STREAM_START_CMD:
+				if len(data) < 5:
+					data += os.read(self.master_fd, 5 - len(data))
+					continue
+				self.stream_interval = max(1, struct.unpack('<I', data[1:5])[0]) / 1000
+				self.next_stream_time = time.monotonic()
+				data = data[5:]
+			elif command == STREAM_STOP_CMD:
+				self.stream_interval = None
+				data = data[1:]
+			else:
+				data = data[1:]
+
+	def thread_main(self):
+		# setup, as a board would after the port opening resets it
+		time.sleep(self.setup_delay)
+		os.write(self.master_fd, b"Initializing sensors...\r\nSETUP DONE!\r\n")
+		while self.running:
+			timeout = 0.1
+			if self.stream_interval is not None:
+				timeout = max(0, min(timeout, self.next_stream_time - time.monotonic()))
+			readable, _, _ = select.select([self.master_fd], [], [], timeout)
+			if readable:
+				try:
+					self.handle_commands(os.read(self.master_fd, 1024))
+				except OSError:
+					return
+			if self.stream_interval is not None and time.monotonic() >= self.next_stream_time:
+				self.send(encode_frame(self.next_payload()))
+				self.next_stream_time += self.stream_interval
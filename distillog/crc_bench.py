@@ -0,0 +1,75 @@
+import argparse
+import ctypes
+import os
+import time
+
+import numpy as np
+from arduino_proto import ArduinoLogger, ACK, crc16, validate_frames
+
+# Compares frame checksum validation rates: the original bit-by-bit CRC16
+# loop, the table-driven crc16() per frame, and validate_frames() checking
+# a whole buffer of frames at once.
+#
+# usage: python crc_bench.py [--frames 100000]
+
+def crc16_update_bitwise(crc, a):
+	crc ^= a
+	for i in range(0, 8):
+		if crc & 1:
+			crc = (crc >> 1) ^ 0xA001
+		else:
+			crc = (crc >> 1)
+	return crc
+	
+def make_frames(frame_count, payload_len):
+	frames = bytearray()
+	for index in range(frame_count):
+		payload = os.urandom(payload_len)
+		frames.append(ACK)
+		frames.extend(crc16(payload).to_bytes(2, byteorder="little"))
+		frames.extend(payload)
+	return bytes(frames)
+	
+def check_bitwise(buffer, payload_len):
+	frame_len = payload_len + 3
+	valid = 0
+	for offset in range(0, len(buffer), frame_len):
+		frame = buffer[offset:offset + frame_len]
+		checksum_calced = 0
+		for byte in frame[3:]:
+			checksum_calced = crc16_update_bitwise(checksum_calced, byte)
+		valid += frame[0] == ACK and checksum_calced == int.from_bytes(frame[1:3], byteorder="little")
+	return valid
+	
+def check_table(buffer, payload_len):
+	frame_len = payload_len + 3
+	valid = 0
+	for offset in range(0, len(buffer), frame_len):
+		frame = buffer[offset:offset + frame_len]
+		valid += frame[0] == ACK and crc16(frame[3:]) == int.from_bytes(frame[1:3], byteorder="little")
+	return valid
+	
+def check_batch(buffer, payload_len):
+	return int(np.count_nonzero(validate_frames(buffer, payload_len)))
+	
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark CRC16 frame validation")
+	parser.add_argument("--frames", type=int, default=100000)
+	args = parser.parse_args()
+	
+	payload_len = ctypes.sizeof(ArduinoLogger.SerialDataMsg)
+	buffer = make_frames(args.frames, payload_len)
+	print("{0:>10} {1:>14} {2:>9}".format("method", "frames/sec", "speedup"))
+	base_rate = None
+	for name, check in [("bitwise", check_bitwise), ("table", check_table), ("batch", check_batch)]:
+		start_time = time.perf_counter()
+		valid = check(buffer, payload_len)
+		elapsed = time.perf_counter() - start_time
+		if valid != args.frames:
+			print("{0}: only {1} of {2} frames validated".format(name, valid, args.frames))
+		rate = args.frames / elapsed
+		base_rate = base_rate or rate
+		print("{0:>10} {1:>14.0f} {2:>8.1f}x".format(name, rate, rate / base_rate))
+		
+if __name__ == "__main__":
+	main()
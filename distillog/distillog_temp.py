@@ -5,7 +5,8 @@ import sys
 import glob
 import serial
 import math
-from arduino_proto import ArduinoLogger
+from arduino_proto import ArduinoLogger, TEMPERATURE_SCHEMA
+from lod import MinMaxPyramid
 
 import numpy as np
 from matplotlib.backends.backend_tkagg import (
@@ -27,6 +28,9 @@ Y_AXIS_MIN_VALUE = 32
 DEFAULT_X_AXIS_MAX = 200
 X_AXIS_MAX_VALUE = 1000
 X_AXIS_MIN_VALUE = 5
+# the x axis doubles as data reaches its end, so it is rescaled (a full
+# redraw) only a handful of times per run
+X_AXIS_GROWTH = 2
 
 UNIT_LOOKUP = ['', u'\N{DEGREE SIGN}' + 'F', u'\N{DEGREE SIGN}' + 'C', 'K']
 
@@ -142,10 +146,15 @@ class DistillogTempInterface:
 		self.temp_axes.set_ylabel('Temperature (F)')
 		self.temp_axes.set_ylim([DEFAULT_Y_AXIS_MIN, DEFAULT_Y_AXIS_MAX])
 		self.temp_axes.set_xlim([0, X_AXIS_MIN_VALUE])
+		# Lines are animated: full redraws leave them out, and new data is
+		# shown by blitting them over a saved copy of the static background
+		self.gas_temp_line, = self.temp_axes.plot([], [], animated=True)
+		self.plot_background = None
 		
 		# matplotlib embedded
 		self.temp_graph = FigureCanvasTkAgg(self.graph_figure, master=self.graph_frame)
 		self.temp_graph.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+		self.temp_graph.mpl_connect('draw_event', self.on_graph_draw)
 		
 		#############
 		# Variables #
@@ -164,9 +173,9 @@ class DistillogTempInterface:
 		self.y_axis_min = DEFAULT_Y_AXIS_MIN
 		
 		self.data_points = 0
-		self.x_time = []
-		self.y_gas_temp = []
-		self.y_outlet_temp = []
+		# the plotted series is kept as a min/max pyramid so the plot only
+		# gets about one point per pixel however long the run
+		self.gas_temp_lod = MinMaxPyramid()
 		
 		# Get serial ports
 		self.refresh_serial_ports()
@@ -208,7 +217,7 @@ class DistillogTempInterface:
 				# Get poll data queue
 				poll_data = self.data_logger.get_queued_data()
 				# Graph the data
-				if poll_data:
+				if len(poll_data):
 					self.data_points += len(poll_data)
 					self.plot_new_data(poll_data)
 				
@@ -219,22 +228,42 @@ class DistillogTempInterface:
 		
 	def plot_new_data(self, data):
 		# Create data points
-		for point in data:
-			self.y_gas_temp.append(point[0])
-			self.y_outlet_temp.append(point[1])
-			self.x_time.append(point[2])
-		plot_lines = self.temp_axes.get_lines()
+		data = data[data['type'] == TEMPERATURE_SCHEMA.type_id]
+		if not len(data):
+			return
+		self.gas_temp_lod.extend(data['timestamp'], data['gasTemp'])
 		# Update scale
-		elapsed_seconds = self.x_time[-1]
-		if elapsed_seconds < self.x_axis_max:
-			self.temp_axes.set_xlim([0, max(X_AXIS_MIN_VALUE, math.ceil(elapsed_seconds))])
-		if plot_lines:
-			plot_lines[0].set_data(self.x_time, self.y_gas_temp)
-			self.temp_axes.draw_artist(plot_lines[0])
+		elapsed_seconds = self.gas_temp_lod.last_x()
+		x_axis_end = self.temp_axes.get_xlim()[1]
+		if elapsed_seconds > x_axis_end and x_axis_end < self.x_axis_max:
+			while x_axis_end < elapsed_seconds:
+				x_axis_end *= X_AXIS_GROWTH
+			self.temp_axes.set_xlim([0, min(self.x_axis_max, math.ceil(x_axis_end))])
+			self.update_line_data()
 			self.temp_graph.draw()
 		else:
-			self.temp_axes.plot(self.x_time, self.y_gas_temp)
+			self.update_line_data()
+			self.blit_lines()
+		
+	# Gives the line about one point per horizontal pixel of the visible window
+	def update_line_data(self):
+		x_start, x_end = self.temp_axes.get_xlim()
+		max_points = max(1, int(self.temp_axes.bbox.width))
+		self.gas_temp_line.set_data(*self.gas_temp_lod.visible(x_start, x_end, max_points))
+		
+	# Saves the background after every full redraw, then draws the lines over it
+	def on_graph_draw(self, event):
+		self.plot_background = self.temp_graph.copy_from_bbox(self.temp_axes.bbox)
+		self.temp_axes.draw_artist(self.gas_temp_line)
+		
+	# Redraws only the lines
+	def blit_lines(self):
+		if self.plot_background is None:
 			self.temp_graph.draw()
+			return
+		self.temp_graph.restore_region(self.plot_background)
+		self.temp_axes.draw_artist(self.gas_temp_line)
+		self.temp_graph.blit(self.temp_axes.bbox)
 		
 	# Disables or enables serial options and label based on serial status
 	def refresh_serial_options(self):
@@ -311,9 +340,9 @@ class DistillogTempInterface:
 			return
 		# Cleanup old
 		self.data_points = 0
-		self.x_time = []
-		self.y_gas_temp = []
-		self.y_outlet_temp = []
+		self.gas_temp_lod = MinMaxPyramid()
+		self.gas_temp_line.set_data([], [])
+		self.temp_graph.draw()
 		# Create new data logger
 		self.data_logger = ArduinoLogger(port)
 		self.data_logger.start_thread()
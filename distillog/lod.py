@@ -0,0 +1,133 @@
+import numpy as np
+
+# Level of detail for long time series
+# A MinMaxPyramid keeps the raw samples plus levels of min/max summaries,
+# each level summarising LOD_FACTOR bins of the one below. A query for a
+# visible window picks the coarsest level that still gives about as many
+# points as there are pixels, and returns the min and max of every bin in
+# time order, so spikes survive however far the view is zoomed out. The
+# work per query depends on the pixel count, not on the length of the run.
+
+# bins of each level merged into one bin of the next
+LOD_FACTOR = 4
+
+# Numpy array that grows by doubling, for appending in batches
+class GrowableArray:
+	def __init__(self, dtype=np.float64, capacity=1024):
+		self.data = np.empty(capacity, dtype=dtype)
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def extend(self, values):
+		new_size = self.size + len(values)
+		if new_size > len(self.data):
+			data = np.empty(max(new_size, 2 * len(self.data)), dtype=self.data.dtype)
+			data[:self.size] = self.data[:self.size]
+			self.data = data
+		self.data[self.size:new_size] = values
+		self.size = new_size
+
+	def view(self):
+		return self.data[:self.size]
+
+# One level of summaries: the minimum and maximum of each bin and when they occurred
+class MinMaxLevel:
+	def __init__(self):
+		self.min_x = GrowableArray()
+		self.min_y = GrowableArray()
+		self.max_x = GrowableArray()
+		self.max_y = GrowableArray()
+
+	def __len__(self):
+		return len(self.min_y)
+
+	# Adds bins made from groups of factor consecutive entries of the given arrays
+	def add_bins(self, min_x, min_y, max_x, max_y, factor):
+		rows = np.arange(len(min_y) // factor)
+		min_index = min_y.reshape(-1, factor).argmin(axis=1)
+		max_index = max_y.reshape(-1, factor).argmax(axis=1)
+		self.min_x.extend(min_x.reshape(-1, factor)[rows, min_index])
+		self.min_y.extend(min_y.reshape(-1, factor)[rows, min_index])
+		self.max_x.extend(max_x.reshape(-1, factor)[rows, max_index])
+		self.max_y.extend(max_y.reshape(-1, factor)[rows, max_index])
+
+class MinMaxPyramid:
+	def __init__(self, factor=LOD_FACTOR):
+		self.factor = factor
+		self.x = GrowableArray()
+		self.y = GrowableArray()
+		self.levels = []
+
+	def __len__(self):
+		return len(self.x)
+
+	def last_x(self):
+		return self.x.data[self.x.size - 1] if self.x.size else None
+
+	# Appends samples, x increasing, and extends every level with the bins they complete
+	def extend(self, x, y):
+		self.x.extend(x)
+		self.y.extend(y)
+		child_x = self.x.view()
+		child_min = child_max = self.y.view()
+		child_min_x = child_max_x = child_x
+		level_index = 0
+		while len(child_min) >= self.factor:
+			if level_index == len(self.levels):
+				self.levels.append(MinMaxLevel())
+			level = self.levels[level_index]
+			start = len(level) * self.factor
+			end = len(child_min) // self.factor * self.factor
+			if end > start:
+				level.add_bins(child_min_x[start:end], child_min[start:end],
+					child_max_x[start:end], child_max[start:end], self.factor)
+			child_min_x = level.min_x.view()
+			child_min = level.min_y.view()
+			child_max_x = level.max_x.view()
+			child_max = level.max_y.view()
+			level_index += 1
+
+	# Returns (x, y) arrays for plotting the samples between x_start and
+	# x_end in about max_points points
+	def visible(self, x_start, x_end, max_points):
+		x = self.x.view()
+		y = self.y.view()
+		# include the samples either side so the line runs to the edges
+		start = max(0, int(np.searchsorted(x, x_start)) - 1)
+		end = min(len(x), int(np.searchsorted(x, x_end, side='right')) + 1)
+		if end - start <= max_points:
+			return x[start:end], y[start:end]
+		# the finest level with no more bins than max_points, so every pixel
+		# column gets at most one bin's minimum and maximum
+		level_index = 0
+		bin_size = self.factor
+		while level_index + 1 < len(self.levels) and (end - start) / bin_size > max_points:
+			level_index += 1
+			bin_size *= self.factor
+		level = self.levels[level_index]
+		first_bin = start // bin_size
+		last_bin = min(len(level), -(-end // bin_size))
+		min_x = level.min_x.view()[first_bin:last_bin]
+		min_y = level.min_y.view()[first_bin:last_bin]
+		max_x = level.max_x.view()[first_bin:last_bin]
+		max_y = level.max_y.view()[first_bin:last_bin]
+		# samples after the last complete bin, fewer than bin_size, are summarised on the spot
+		tail_start = last_bin * bin_size
+		if tail_start < end:
+			tail_min = tail_start + int(y[tail_start:end].argmin())
+			tail_max = tail_start + int(y[tail_start:end].argmax())
+			min_x = np.append(min_x, x[tail_min])
+			min_y = np.append(min_y, y[tail_min])
+			max_x = np.append(max_x, x[tail_max])
+			max_y = np.append(max_y, y[tail_max])
+		# interleave each bin's minimum and maximum in time order
+		min_first = min_x <= max_x
+		points_x = np.empty(2 * len(min_x))
+		points_y = np.empty(2 * len(min_y))
+		points_x[0::2] = np.where(min_first, min_x, max_x)
+		points_x[1::2] = np.where(min_first, max_x, min_x)
+		points_y[0::2] = np.where(min_first, min_y, max_y)
+		points_y[1::2] = np.where(min_first, max_y, min_y)
+		return points_x, points_y
@@ -0,0 +1,263 @@
+import collections
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+import numpy as np
+
+# Link health statistics for ArduinoLogger
+# Counts what happened to every poll and frame, times round trips, poll
+# lateness and sample intervals, tracks msgId gaps, and can be dumped to a
+# JSON file once or periodically while acquiring.
+
+# Round trip histogram bucket upper bounds in seconds, from 100 us to 5 s
+RTT_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+				0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+# batches of samples used for the recent sample rate
+RATE_WINDOW = 100
+
+# Summary of a series of durations in seconds
+# Keeps the count, mean and standard deviation (Welford's update, so long
+# runs don't lose precision) and the extremes. Given bucket bounds it also
+# counts values per bucket, for quantiles; series that can go negative,
+# such as sample interval errors, are kept without buckets.
+class TimingSeries:
+	def __init__(self, buckets=None):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1) if buckets else None
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, value):
+		if self.buckets:
+			self.counts[bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def stddev(self):
+		return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+	# Upper bound of the bucket holding the given quantile, the maximum for the overflow bucket
+	def quantile(self, q):
+		if not self.count:
+			return None
+		target = q * self.count
+		running = 0
+		for index, count in enumerate(self.counts):
+			running += count
+			if running >= target:
+				return self.buckets[index] if index < len(self.buckets) else self.max
+		return self.max
+
+	def snapshot(self):
+		snapshot = {"count": self.count, "mean": self.mean if self.count else None, "stddev": self.stddev(),
+					"min": self.min, "max": self.max}
+		if self.buckets:
+			snapshot.update({"p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+							"buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts))})
+		return snapshot
+
+class LoggerStats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.start_time = time.monotonic()
+			self.polls_sent = 0
+			self.samples = 0
+			# replies shorter than a frame, including none at all
+			self.short_reads = 0
+			# replies that did not start with ACK
+			self.naks = 0
+			self.crc_failures = 0
+			# frames of a type or length no schema describes
+			self.unknown_frames = 0
+			# frames missing from the msgId sequence, and jumps backwards
+			# (the board restarting or replying out of order)
+			self.lost_frames = 0
+			self.msg_id_resets = 0
+			self.last_msg_id = None
+			self.first_batch = None
+			self.rtt = TimingSeries(RTT_BUCKETS)
+			# how late each poll was sent, and how far each sample interval
+			# was from the requested one
+			self.poll_lateness = TimingSeries()
+			self.sample_jitter = TimingSeries()
+			# poll slots skipped after falling too far behind
+			self.missed_polls = 0
+			# (time, total samples) after each batch
+			self.batches = collections.deque(maxlen=RATE_WINDOW)
+
+	def poll_sent(self):
+		with self.lock:
+			self.polls_sent += 1
+
+	def observe_rtt(self, seconds):
+		with self.lock:
+			self.rtt.add(seconds)
+			
+	def observe_poll_lateness(self, seconds):
+		with self.lock:
+			self.poll_lateness.add(seconds)
+			
+	def observe_sample_jitter(self, seconds):
+		with self.lock:
+			self.sample_jitter.add(seconds)
+			
+	def missed_poll(self, count=1):
+		with self.lock:
+			self.missed_polls += count
+
+	def short_read(self):
+		with self.lock:
+			self.short_reads += 1
+
+	def nak(self):
+		with self.lock:
+			self.naks += 1
+
+	def crc_failure(self, count=1):
+		with self.lock:
+			self.crc_failures += count
+
+	def unknown_frame(self, count=1):
+		with self.lock:
+			self.unknown_frames += count
+
+	# Counts a batch of samples received together, given their msgIds
+	def sample(self, msg_ids, monotonic_time):
+		if len(msg_ids) == 1:
+			self.single_sample(int(msg_ids[0]), monotonic_time)
+			return
+		msg_ids = np.asarray(msg_ids, dtype=np.int64)
+		if not len(msg_ids):
+			return
+		with self.lock:
+			self.samples += len(msg_ids)
+			self.batches.append((monotonic_time, self.samples))
+			if self.first_batch is None:
+				self.first_batch = self.batches[0]
+			if self.last_msg_id is not None:
+				previous_ids = np.concatenate(([self.last_msg_id], msg_ids[:-1]))
+				current_ids = msg_ids
+			else:
+				previous_ids = msg_ids[:-1]
+				current_ids = msg_ids[1:]
+			gaps = (current_ids - previous_ids - 1) & 0xFFFF
+			# msgId is 16 bits and wraps, so a gap of more than half the
+			# range is really the sequence going backwards
+			backwards = gaps >= 0x8000
+			self.msg_id_resets += int(np.count_nonzero(backwards))
+			self.lost_frames += int(gaps[~backwards].sum())
+			self.last_msg_id = int(msg_ids[-1])
+
+	# sample() for one msgId, without the NumPy overhead
+	def single_sample(self, msg_id, monotonic_time):
+		with self.lock:
+			self.samples += 1
+			self.batches.append((monotonic_time, self.samples))
+			if self.first_batch is None:
+				self.first_batch = self.batches[0]
+			if self.last_msg_id is not None:
+				gap = (msg_id - self.last_msg_id - 1) & 0xFFFF
+				if gap >= 0x8000:
+					self.msg_id_resets += 1
+				else:
+					self.lost_frames += gap
+			self.last_msg_id = msg_id
+
+	# Samples per second between two (time, total samples) points
+	def rate_between(self, first, last):
+		if last[0] == first[0]:
+			return None
+		return (last[1] - first[1]) / (last[0] - first[0])
+
+	# Samples per second since the first batch
+	def average_rate(self):
+		return self.rate_between(self.first_batch, self.batches[-1]) if self.batches else None
+
+	# Samples per second over the last RATE_WINDOW batches
+	def recent_rate(self):
+		return self.rate_between(self.batches[0], self.batches[-1]) if self.batches else None
+
+	# Poll and sample timing, in seconds
+	def timing_snapshot(self):
+		with self.lock:
+			return {"poll_lateness": self.poll_lateness.snapshot(),
+					"sample_jitter": self.sample_jitter.snapshot(),
+					"missed_polls": self.missed_polls}
+		
+	def snapshot(self):
+		timing = self.timing_snapshot()
+		with self.lock:
+			return {"elapsed_seconds": time.monotonic() - self.start_time,
+					"polls_sent": self.polls_sent,
+					"samples": self.samples,
+					"short_reads": self.short_reads,
+					"naks": self.naks,
+					"crc_failures": self.crc_failures,
+					"unknown_frames": self.unknown_frames,
+					"lost_frames": self.lost_frames,
+					"msg_id_resets": self.msg_id_resets,
+					"average_rate": self.average_rate(),
+					"recent_rate": self.recent_rate(),
+					"rtt_seconds": self.rtt.snapshot(),
+					"timing": timing}
+
+# Writes a stats snapshot to filename as JSON
+# The snapshot goes to a temporary file that is then renamed over the old
+# one, so a monitor reading the file mid-acquisition gets the previous
+# snapshot or this one, never half of it.
+def dump_stats(snapshot, filename):
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w") as stats_file:
+		json.dump(snapshot, stats_file, indent=2, sort_keys=True)
+	os.replace(temp_filename, filename)
+
+# Writes the logger's stats file every interval seconds from its own thread
+# snapshot is called with no arguments, typically ArduinoLogger.get_stats.
+# stop() writes the file once more, so it ends with the final counts.
+class StatsReporter:
+	def __init__(self, snapshot, filename, interval=5):
+		self.snapshot = snapshot
+		self.filename = filename
+		self.interval = interval
+		self.stop_event = threading.Event()
+		self.thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def start(self):
+		self.stop_event.clear()
+		self.thread = threading.Thread(target=self.thread_main, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stop_event.set()
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+		dump_stats(self.snapshot(), self.filename)
+
+	def thread_main(self):
+		while not self.stop_event.wait(self.interval):
+			dump_stats(self.snapshot(), self.filename)
@@ -0,0 +1,161 @@
+import os
+import struct
+import time
+import numpy as np
+
+# Binary recordings of acquisition sessions
+# A session file is a short header followed by fixed-size records, each a
+# frame payload behind the host timestamp. Payloads of every frame type share
+# the record, padded with zeros to the size given in the header, and start
+# with the type byte that says how to read the rest. Timestamps are seconds
+# since the session started on the monotonic clock, so they never go
+# backwards; the header holds the wall clock start time. A sidecar index
+# holds the timestamp of every INDEX_INTERVAL-th record, letting a reader
+# find a time range by touching a handful of pages of the memory-mapped file.
+
+SESSION_MAGIC = b'DLOG'
+SESSION_VERSION = 2
+# magic, version, record size, wall clock start time
+SESSION_HEADER = struct.Struct('<4sHHd')
+HEADER_SIZE = 64
+
+RECORD_TIME = struct.Struct('<d')
+
+# Record layout for payloads of up to payload_size bytes
+def record_dtype(payload_size):
+	return np.dtype([('hostTime', '<f8'), ('payload', 'u1', (payload_size,))])
+
+# every this many records get an index entry
+INDEX_INTERVAL = 1024
+# index entry: record number, timestamp
+INDEX_ENTRY = struct.Struct('<Qd')
+INDEX_DTYPE = np.dtype([('record', '<u8'), ('hostTime', '<f8')])
+
+# buffered records are written out at least this often in seconds
+FLUSH_INTERVAL = 1.0
+
+def index_filename(filename):
+	return filename + '.idx'
+	
+# Returns filename, or if it or its index exists, the first free name of
+# the form name-1.ext, name-2.ext, ..., so a new session never replaces one
+def unused_filename(filename):
+	base, extension = os.path.splitext(filename)
+	candidate = filename
+	number = 0
+	while os.path.exists(candidate) or os.path.exists(index_filename(candidate)):
+		number += 1
+		candidate = '{0}-{1}{2}'.format(base, number, extension)
+	return candidate
+
+# Appends records to a new session file
+# Writes go through a file buffer and are flushed every FLUSH_INTERVAL, so
+# the acquisition thread only pays for a small buffered write per sample.
+# An existing session file is never overwritten: FileExistsError is raised
+# instead, see unused_filename. payload_size is the longest payload written.
+class SessionRecorder:
+	def __init__(self, filename, payload_size):
+		self.filename = filename
+		self.payload_size = payload_size
+		self.start_time = time.monotonic()
+		self.record_count = 0
+		self.last_flush_time = self.start_time
+		self.data_file = open(filename, 'xb', buffering=64 * 1024)
+		try:
+			self.index_file = open(index_filename(filename), 'xb')
+		except OSError:
+			self.data_file.close()
+			os.remove(filename)
+			raise
+		header = SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, RECORD_TIME.size + payload_size, time.time())
+		self.data_file.write(header.ljust(HEADER_SIZE, b'\0'))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	# Adds a frame received at the given time.monotonic() time
+	def write(self, payload, monotonic_time=None):
+		if monotonic_time is None:
+			monotonic_time = time.monotonic()
+		host_time = monotonic_time - self.start_time
+		if len(payload) > self.payload_size:
+			raise ValueError('payload is {0} bytes, at most {1} fit a record'.format(len(payload), self.payload_size))
+		if self.record_count % INDEX_INTERVAL == 0:
+			self.index_file.write(INDEX_ENTRY.pack(self.record_count, host_time))
+		self.data_file.write(RECORD_TIME.pack(host_time))
+		self.data_file.write(payload.ljust(self.payload_size, b'\0'))
+		self.record_count += 1
+		if monotonic_time - self.last_flush_time >= FLUSH_INTERVAL:
+			self.flush()
+			self.last_flush_time = monotonic_time
+
+	def flush(self):
+		self.data_file.flush()
+		self.index_file.flush()
+
+	def close(self):
+		self.data_file.close()
+		self.index_file.close()
+
+# Random access to a session file through a memory map
+# records is a read-only structured array backed by the file, so slicing it
+# reads only the pages that are used. A record cut short by a crash is ignored.
+class SessionReader:
+	def __init__(self, filename):
+		self.filename = filename
+		with open(filename, 'rb') as data_file:
+			header = data_file.read(HEADER_SIZE)
+		if len(header) < SESSION_HEADER.size:
+			raise ValueError('{0} is not a session file'.format(filename))
+		magic, version, record_size, self.start_time = SESSION_HEADER.unpack_from(header)
+		if magic != SESSION_MAGIC or version != SESSION_VERSION or record_size <= RECORD_TIME.size:
+			raise ValueError('{0} is not a version {1} session file'.format(filename, SESSION_VERSION))
+		dtype = record_dtype(record_size - RECORD_TIME.size)
+		record_count = (os.path.getsize(filename) - HEADER_SIZE) // record_size
+		if record_count > 0:
+			self.records = np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(record_count,))
+		else:
+			self.records = np.zeros(0, dtype=dtype)
+		self.index = self.load_index(record_count)
+
+	def __len__(self):
+		return len(self.records)
+
+	# Reads the sidecar index, rebuilding it from the records if it is missing
+	def load_index(self, record_count):
+		try:
+			index = np.fromfile(index_filename(self.filename), dtype=INDEX_DTYPE)
+		except FileNotFoundError:
+			index = np.zeros(0, dtype=INDEX_DTYPE)
+		index = index[index['record'] < record_count]
+		expected_entries = (record_count + INDEX_INTERVAL - 1) // INDEX_INTERVAL
+		if len(index) < expected_entries:
+			index = np.zeros(expected_entries, dtype=INDEX_DTYPE)
+			index['record'] = np.arange(expected_entries) * INDEX_INTERVAL
+			index['hostTime'] = self.records['hostTime'][::INDEX_INTERVAL]
+		return index
+
+	# Returns the position of the first record at or after host_time
+	def find(self, host_time):
+		# the block before the first one starting at host_time, since records
+		# sharing that time can end the previous block
+		block = max(0, int(np.searchsorted(self.index['hostTime'], host_time, side='left')) - 1)
+		if not len(self.index):
+			return 0
+		start = int(self.index['record'][block])
+		end = min(start + INDEX_INTERVAL, len(self.records))
+		return start + int(np.searchsorted(self.records['hostTime'][start:end], host_time))
+
+	# Returns the records with start <= hostTime < end as a view of the file
+	def time_range(self, start, end):
+		return self.records[self.find(start):self.find(end)]
+
+	def duration(self):
+		return float(self.records['hostTime'][-1]) if len(self.records) else 0.0
+
+	# The map is released once no views of the records remain
+	def close(self):
+		self.records = None
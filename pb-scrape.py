@@ -25,15 +25,58 @@
 """
 
 import requests
+import argparse
+import contextlib
 import time
 import csv
-from lxml import html
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from requests.adapters import HTTPAdapter
+from lxml import html, etree
 from decimal import *
+from pb_cache import PageCache
+from pb_store import PeakDatabase
+from pb_spatial import PeakIndex
+from pb_metrics import Metrics, MetricsReporter
 
 PB_PEAK_FORMAT = "https://www.peakbagger.com/peak.aspx?pid={0}"
-REQUEST_COOLDOWN = 1.5 # time to wait before consecutive PB requests
+
+REQUEST_RATE = 2.0 # max requests per second to a single host
+REQUEST_BURST = 2 # requests that may go out back-to-back before the rate applies
+MIN_REQUEST_RATE = 0.1 # floor for the adaptive rate when the server is struggling
+FETCH_WORKERS = 4 # concurrent page downloads
+PARSE_WORKERS = os.cpu_count() or 1 # processes parsing downloaded pages
+FETCH_RETRIES = 4 # attempts per page before giving up
+FETCH_TIMEOUT = 30 # seconds before a request is abandoned
+SLOW_RESPONSE = 5.0 # responses slower than this (seconds) reduce the request rate
+RETRY_BACKOFF = 1.5 # seconds to wait before the first retry, doubled each attempt
+# request errors worth another attempt, and ones that no retry will fix
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+					requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+INVALID_URL_ERRORS = (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+					requests.exceptions.InvalidURL, requests.exceptions.URLRequired)
+
+CACHE_FILENAME = "pb_cache.sqlite"
+CACHE_MAX_SIZE = 256 * 1024 * 1024 # bytes of compressed pages to keep on disk
+PEAK_CACHE_TTL = 30 * 24 * 60 * 60 # seconds before a cached peak page is revalidated
+LIST_CACHE_TTL = 24 * 60 * 60 # seconds before a cached list page is revalidated
+
+LIST_PARSE_CHUNK = 64 * 1024 # bytes of list page fed to the parser at a time
+
+# Per-stage timings and counters for the whole run
+# Stage latencies go in the stage_seconds histogram labelled by stage
+METRICS = Metrics("pb_scrape")
 
 CSV_FILENAME = "peaks.csv"
+MERGED_CSV_FILENAME = "peaks_merged.csv"
+PEAK_DB_FILENAME = "peaks.sqlite"
+JOURNAL_FILENAME = "peaks.journal"
 
 us_state_abbrev = {
 	'Alabama': 'AL', 'Alaska': 'AK', 'American Samoa': 'AS', 'Arizona': 'AZ',
@@ -55,6 +98,207 @@ us_state_abbrev = {
 	'West Virginia': 'WV', 'Wisconsin': 'WI', 'Wyoming': 'WY'
 }
 
+# Token bucket limiting the request rate to one host
+# The rate adapts: it is cut when the server is slow or refuses requests
+# and recovers gradually back to the configured maximum
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.max_rate = rate
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last_refill = time.monotonic()
+		self.lock = threading.Lock()
+		
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+		self.last_refill = now
+		
+	# Blocks until a request may be sent, returning the seconds spent waiting
+	def acquire(self):
+		waited = 0
+		while True:
+			with self.lock:
+				self.refill()
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return waited
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+			waited += wait
+			
+	def slow_down(self):
+		with self.lock:
+			self.refill()
+			self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+			
+	def speed_up(self):
+		with self.lock:
+			self.refill()
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+			
+	# Holds off every request to this host for the given number of seconds
+	def pause(self, seconds):
+		with self.lock:
+			self.refill()
+			self.tokens = min(self.tokens, -seconds * self.rate)
+			
+# Page served from the local cache, standing in for a requests.Response
+class CachedPage:
+	def __init__(self, url, content):
+		self.url = url
+		self.content = content
+		self.status_code = 200
+		self.from_cache = True
+		
+# Downloads pages on a pool of worker threads sharing one keep-alive session
+# Pages are looked up in the cache first, if one is given
+class PageFetcher:
+	def __init__(self, rate=REQUEST_RATE, workers=FETCH_WORKERS, cache=None):
+		self.rate = rate
+		self.workers = workers
+		self.cache = cache
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.buckets = {}
+		self.buckets_lock = threading.Lock()
+		self.cache_lookups = 0
+		self.cache_hits = 0
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		
+	def __enter__(self):
+		return self
+		
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		
+	def close(self):
+		self.executor.shutdown(wait=True, cancel_futures=True)
+		self.session.close()
+		
+	def host_bucket(self, url):
+		host = urlsplit(url).netloc
+		with self.buckets_lock:
+			if host not in self.buckets:
+				self.buckets[host] = TokenBucket(self.rate, REQUEST_BURST)
+			return self.buckets[host]
+			
+	def count_cache_lookup(self, result):
+		METRICS.increment("cache_lookups", result=result)
+		with self.buckets_lock:
+			self.cache_lookups += 1
+			if result == "hit":
+				self.cache_hits += 1
+			METRICS.set_gauge("cache_hit_ratio", self.cache_hits / self.cache_lookups)
+			
+	# Retrieves a single page, retrying on transient errors, 429 and 5xx
+	# Returns the response, or None if the URL is invalid, the request failed
+	# for good, the server answered with a status other than 200 or 304, or
+	# every attempt failed
+	# With revalidate set, cached pages are always checked with the server
+	def fetch(self, url, ttl=None, revalidate=False):
+		cache_entry = None
+		request_headers = {}
+		if self.cache:
+			with METRICS.timer("stage_seconds", stage="cache_lookup"):
+				cache_entry = self.cache.get(url)
+			if cache_entry:
+				if cache_entry.is_fresh() and not revalidate:
+					self.count_cache_lookup("hit")
+					return CachedPage(url, cache_entry.content)
+				self.count_cache_lookup("stale")
+				request_headers = cache_entry.validators()
+			else:
+				self.count_cache_lookup("miss")
+		bucket = self.host_bucket(url)
+		backoff = RETRY_BACKOFF
+		for attempt in range(FETCH_RETRIES):
+			if attempt > 0:
+				METRICS.increment("retries")
+				METRICS.observe("stage_seconds", backoff, stage="retry_backoff")
+				time.sleep(backoff)
+				backoff *= 2
+			METRICS.observe("stage_seconds", bucket.acquire(), stage="rate_limit_wait")
+			start_time = time.monotonic()
+			try:
+				response = self.session.get(url, headers=request_headers, timeout=FETCH_TIMEOUT)
+			except INVALID_URL_ERRORS as err:
+				print("Invalid URL {0}: {1}".format(url, err))
+				METRICS.increment("errors", kind=type(err).__name__)
+				METRICS.increment("failed_pages")
+				return None
+			except TRANSIENT_ERRORS as err:
+				print("Failed to retrieve {0} (attempt {1}/{2}): {3}".format(url, attempt + 1, FETCH_RETRIES, type(err).__name__))
+				METRICS.increment("errors", kind=type(err).__name__)
+				bucket.slow_down()
+				continue
+			except requests.exceptions.RequestException as err:
+				print("Failed to retrieve {0}: {1}".format(url, err))
+				METRICS.increment("errors", kind=type(err).__name__)
+				METRICS.increment("failed_pages")
+				return None
+			elapsed = time.monotonic() - start_time
+			# response.elapsed runs until the headers arrive, covering connect
+			# and server time; the rest is spent reading the body
+			request_seconds = response.elapsed.total_seconds()
+			METRICS.observe("stage_seconds", request_seconds, stage="request")
+			METRICS.observe("stage_seconds", max(0, elapsed - request_seconds), stage="download")
+			METRICS.increment("requests", status=response.status_code)
+			METRICS.increment("bytes_downloaded", len(response.content))
+			if response.status_code == 429 or response.status_code >= 500:
+				print("Server returned {0} for {1} (attempt {2}/{3})".format(response.status_code, url, attempt + 1, FETCH_RETRIES))
+				METRICS.increment("errors", kind="http_{0}".format(response.status_code))
+				bucket.slow_down()
+				retry_after = response.headers.get("Retry-After", "")
+				if retry_after.isdigit():
+					bucket.pause(int(retry_after))
+				continue
+			if elapsed > SLOW_RESPONSE:
+				bucket.slow_down()
+			else:
+				bucket.speed_up()
+			METRICS.set_gauge("request_rate", bucket.rate, host=urlsplit(url).netloc)
+			# a missing or forbidden page won't appear on a retry
+			if response.status_code not in (200, 304):
+				print("Server returned {0} for {1}".format(response.status_code, url))
+				METRICS.increment("errors", kind="http_{0}".format(response.status_code))
+				METRICS.increment("failed_pages")
+				return None
+			if self.cache:
+				if response.status_code == 304 and cache_entry:
+					METRICS.increment("cache_revalidations", result="not_modified")
+					self.cache.refresh(url, ttl)
+					return CachedPage(url, cache_entry.content)
+				if cache_entry:
+					METRICS.increment("cache_revalidations", result="modified")
+				if response.status_code == 200:
+					self.cache.put(url, response.content, response.headers.get("ETag"),
+									response.headers.get("Last-Modified"), ttl)
+			return response
+		print("Giving up on {0}".format(url))
+		METRICS.increment("failed_pages")
+		return None
+		
+	# Retrieves pages for a stream of items concurrently, yielding (item, page)
+	# in the order given. Only a small window of requests is in flight at once,
+	# so items are consumed lazily. Items whose url_for returns None are passed
+	# through with no page.
+	def fetch_stream(self, items, url_for, ttl=None, revalidate=False):
+		pending = deque()
+		for item in items:
+			url = url_for(item)
+			future = self.executor.submit(self.fetch, url, ttl, revalidate) if url else None
+			pending.append((item, future))
+			if len(pending) > self.workers * 2:
+				item, future = pending.popleft()
+				yield item, future.result() if future else None
+		while pending:
+			item, future = pending.popleft()
+			yield item, future.result() if future else None
+		
 class Peak:
 	def __init__(self, name, elevation, prominance, range, rank, pid):
 		self.peak_name = name
@@ -70,37 +314,140 @@ class Peak:
 		self.alt_names = ""
 		self.state = ""
 		self.state_abbrev = ""
+		self.county = ""
+		self.content_hash = None
 		
-def parse_peak_list(ignored_unranked, list_page):
-	list_page_tree = html.fromstring(list_page.content)
+	# Copies the scraped fields from a journal record
+	def load_record(self, record):
+		self.lat = record["lat"]
+		self.long = record["long"]
+		self.alt_names = record["alt_names"]
+		self.state = record["state"]
+		self.state_abbrev = record["state_abbrev"]
+		self.county = record.get("county", "")
+		self.content_hash = record.get("content_hash")
+		
+# Rebuilds a peak from a database row
+def peak_from_row(row):
+	peak = Peak(row["peak_name"], row["elevation"], row["prominance"], row["range"], row["rank"], row["pid"])
+	peak.load_record(dict(row))
+	return peak
 	
-	titles = list_page_tree.xpath("//h1/text()")
-	if titles:
-		print("Found List: {0}".format(titles[0]))
-	else:
-		print("Unable to find list title")
+# Append-only journal of peaks that have finished scraping, one JSON record
+# per line, so an interrupted scrape can pick up where it left off
+class ProgressJournal:
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = None
 		
-	peaks = []
+	def __enter__(self):
+		self.file = open(self.filename, 'a', encoding='utf-8')
+		return self
 		
-	peak_table = list_page_tree.xpath("//table[@class=\"gray\"]")
-	if peak_table:
-		print("\n\tPeak Name\t\t\tElevation\tProminance\tRange")
-		print("-------------------------------------------------------------------------------------------------")
-		try:
-			peak_list = peak_table[0].xpath(".//tr")
-			for peak_row in peak_list[2:]:
-				peak_columns = peak_row.xpath(".//td")
-				ranked_str = peak_columns[0].text
-				if not ranked_str.strip() and ignored_unranked:
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.file.close()
+		self.file = None
+		
+	# Returns the completed records keyed by pid
+	def load(self):
+		records = {}
+		if not os.path.exists(self.filename):
+			return records
+		with open(self.filename, encoding='utf-8') as journal_file:
+			for line in journal_file:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# A crash can leave the last line half written
 					continue
-				rank = int(ranked_str.replace('.',''))
-				title = peak_columns[1].xpath("./a/text()")[0]
-				link = peak_columns[1].xpath("./a/@href")[0]
-				pid = int(link.split("pid=")[1])
-				elevation = int(peak_columns[2].text)
-				prominance = int(peak_columns[3].text)
-				range = peak_columns[4].xpath("./a/text()")[0]
-				peaks.append(Peak(title, elevation, prominance, range, rank, pid))
+				records[record["pid"]] = record
+		return records
+		
+	def record(self, peak):
+		self.file.write(json.dumps(vars(peak)) + "\n")
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		
+	def clear(self):
+		if os.path.exists(self.filename):
+			os.remove(self.filename)
+		
+# Splits page content into chunks for the incremental parser
+def page_chunks(content, chunk_size=LIST_PARSE_CHUNK):
+	for offset in range(0, len(content), chunk_size):
+		yield content[offset:offset + chunk_size]
+		
+# Incrementally parses a list page, yielding ("title", text) for the list
+# title, ("table", None) when the peak table starts and ("row", columns) for
+# each peak row, where columns holds the raw rank, name, link, elevation,
+# prominance and range strings. Each row is discarded once it has been read,
+# so memory use does not grow with the length of the list.
+def iter_list_rows(chunks):
+	parser = etree.HTMLPullParser(events=("start", "end"))
+	in_table = False
+	table_done = False
+	row_count = 0
+	for chunk in chunks:
+		parser.feed(chunk)
+		for event, element in parser.read_events():
+			if event == "start":
+				if element.tag == "table" and not table_done and element.get("class") == "gray":
+					in_table = True
+					yield "table", None
+				continue
+			if element.tag == "h1":
+				yield "title", element.text
+			elif in_table and element.tag == "tr":
+				row_count += 1
+				# The first two rows are headers
+				if row_count > 2:
+					yield "row", list_row_columns(element)
+				element.clear()
+				while element.getprevious() is not None:
+					del element.getparent()[0]
+			elif in_table and element.tag == "table":
+				in_table = False
+				table_done = True
+				element.clear()
+	parser.close()
+	
+def list_row_columns(peak_row):
+	peak_columns = list(peak_row.iter("td"))
+	peak_link = peak_columns[1].find("a")
+	range_link = peak_columns[4].find("a")
+	if peak_link is None or range_link is None:
+		raise IndexError("missing link")
+	return (peak_columns[0].text or "", peak_link.text, peak_link.get("href"),
+			peak_columns[2].text, peak_columns[3].text, range_link.text)
+	
+# Yields each peak in the list page as its row is parsed
+def iter_peak_list(ignored_unranked, list_page, verbose=True):
+	found_title = False
+	found_table = False
+	try:
+		for kind, value in iter_list_rows(page_chunks(list_page.content)):
+			if kind == "title":
+				if not found_title:
+					print("Found List: {0}".format(value))
+				found_title = True
+				continue
+			if kind == "table":
+				if not found_title:
+					print("Unable to find list title")
+				found_table = True
+				if verbose:
+					print("\n\tPeak Name\t\t\tElevation\tProminance\tRange")
+					print("-------------------------------------------------------------------------------------------------")
+				continue
+			ranked_str, title, link, elevation, prominance, range = value
+			if not ranked_str.strip() and ignored_unranked:
+				continue
+			# Unranked peaks have a blank rank column
+			rank = int(ranked_str.replace('.','')) if ranked_str.strip() else 0
+			pid = int(link.split("pid=")[1])
+			elevation = int(elevation)
+			prominance = int(prominance)
+			if verbose:
 				if len(title) > 15:
 					title_entry = title + "\t\t"
 				else:
@@ -110,65 +457,270 @@ def parse_peak_list(ignored_unranked, list_page):
 				else:
 					range_entry = "\t\t" + range
 				print(" {0}.\t{1}({2} ft,\t{3} ft){4}".format(rank, title_entry, elevation, prominance, range_entry))
-		except ValueError as err:
-			print("Unexpected value in webpage: {0}".format(err))
-		except IndexError:
-			print("Missing expected element")
-	else:
+			yield Peak(title, elevation, prominance, range, rank, pid)
+	except ValueError as err:
+		print("Unexpected value in webpage: {0}".format(err))
+	except IndexError:
+		print("Missing expected element")
+	if not found_table:
 		print("Unable to find table body")
 		
-	return peaks
+def parse_peak_list(ignored_unranked, list_page):
+	with METRICS.timer("stage_seconds", stage="list_parse"):
+		return list(iter_peak_list(ignored_unranked, list_page))
 	
-def scrape_peak_data(peaks):
-	# Check the page
-	for peak in peaks:
-		# Download the page and generate tree
+# Converters for the peak data table
+# Each takes the value cell of a matched row and returns the Peak attributes it sets
+DEC_DEG_PATTERN = re.compile(r"(-?\d+(?:\.\d+)?),\s*(-?\d+(?:\.\d+)?)\s*\(Dec Deg\)")
+
+def convert_coordinates(cell):
+	match = DEC_DEG_PATTERN.search(cell.text_content())
+	if not match:
+		raise ValueError("no decimal coordinates")
+	return {"lat": float(match.group(1)), "long": float(match.group(2))}
+	
+def convert_alt_names(cell):
+	return {"alt_names": cell.text or ""}
+	
+def convert_state(cell):
+	state = (cell.text or "").replace("(Highest Point)", '').strip()
+	return {"state": state, "state_abbrev": us_state_abbrev.get(state, "")}
+	
+def convert_county(cell):
+	return {"county": cell.text_content().replace("(Highest Point)", '').strip()}
+	
+# A field of the peak data table: rows whose label cell matches the label
+# pattern are handed to the converter
+class PeakField:
+	def __init__(self, name, label, converter):
+		self.name = name
+		self.label = label
+		self.converter = converter
+		
+PEAK_FIELDS = [
+	PeakField("coordinates", r"Latitude.*Longitude", convert_coordinates),
+	PeakField("alt_names", r"Alternate Name\(s\)", convert_alt_names),
+	PeakField("state", r"State", convert_state),
+	PeakField("county", r"County", convert_county),
+]
+
+# Extracts the schema fields from a peak page in a single pass over the
+# first gray table. All labels are compiled into one regex, so each row costs
+# one search no matter how many fields there are.
+class PeakExtractor:
+	def __init__(self, fields):
+		self.fields = fields
+		self.rows_xpath = etree.XPath("(//table[@class=\"gray\"])[1]//tr[td]")
+		self.label_pattern = re.compile("|".join(
+			"(?P<field{0}>{1})".format(index, field.label) for index, field in enumerate(fields)))
+		self.field_lookup = {"field{0}".format(index): field for index, field in enumerate(fields)}
+		self.reset()
+		
+	def reset(self):
+		self.pages = 0
+		self.parse_seconds = 0
+		self.extract_seconds = 0
+		self.hits = {field.name: 0 for field in self.fields}
+		self.misses = {field.name: 0 for field in self.fields}
+		self.errors = {field.name: 0 for field in self.fields}
+		
+	# Returns the extracted values keyed by field name
+	def extract(self, tree):
+		record = {}
+		for row in self.rows_xpath(tree):
+			table_data = row.findall("td")
+			if len(table_data) < 2 or table_data[0].text is None:
+				continue
+			match = self.label_pattern.search(table_data[0].text)
+			if not match:
+				continue
+			field = self.field_lookup[match.lastgroup]
+			if field.name in record:
+				continue
+			try:
+				record[field.name] = field.converter(table_data[1])
+			except ValueError as err:
+				record[field.name] = None
+				print("Unexpected value for {0} in webpage: {1}".format(field.name, err))
+		return record
+		
+	# Adds an extracted record to the hit/miss counters
+	def tally(self, record, parse_seconds, extract_seconds):
+		self.pages += 1
+		self.parse_seconds += parse_seconds
+		self.extract_seconds += extract_seconds
+		METRICS.observe("stage_seconds", parse_seconds, stage="page_parse")
+		METRICS.observe("stage_seconds", extract_seconds, stage="extract")
+		for field in self.fields:
+			if field.name not in record:
+				self.misses[field.name] += 1
+			elif record[field.name] is None:
+				self.errors[field.name] += 1
+			else:
+				self.hits[field.name] += 1
+				
+	def report(self):
+		if not self.pages:
+			return
+		print("\nExtracted {0} pages (parse {1:.0f} us/page, extraction {2:.0f} us/page)".format(
+			self.pages, self.parse_seconds / self.pages * 1e6, self.extract_seconds / self.pages * 1e6))
+		print("  Field\t\tHits\tMisses\tErrors")
+		for field in self.fields:
+			print("  {0:<12}\t{1}\t{2}\t{3}".format(field.name, self.hits[field.name],
+													self.misses[field.name], self.errors[field.name]))
+			
+PEAK_EXTRACTOR = PeakExtractor(PEAK_FIELDS)
+
+# Describes the extraction schema. It is hashed along with each page, so
+# adding or changing a field makes every stored page count as changed and
+# the peaks are extracted again.
+PEAK_SCHEMA_VERSION = "\n".join("{0}:{1}:{2}".format(field.name, field.label, field.converter.__name__)
+								for field in PEAK_FIELDS).encode()
+
+def apply_peak_record(peak, record):
+	for values in record.values():
+		if values:
+			for attribute, value in values.items():
+				setattr(peak, attribute, value)
+				
+# Parses page content into a compact record, along with the time spent
+# building the tree and extracting the fields
+# Runs in the parser processes, so only the record travels back
+def parse_peak_page(content):
+	start_time = time.perf_counter()
+	tree = html.fromstring(content)
+	parsed_time = time.perf_counter()
+	record = PEAK_EXTRACTOR.extract(tree)
+	return record, parsed_time - start_time, time.perf_counter() - parsed_time
+	
+# Hands downloaded pages to the parser pool, yielding (item, parse_peak_page result)
+# in the order given, or (item, None) for items without a page. A window of
+# pages is parsed in parallel while the fetch threads keep downloading.
+# Without a pool, pages are parsed on this thread.
+def parse_page_stream(pages, parser_pool=None, window=PARSE_WORKERS * 2):
+	pending = deque()
+	for item, page in pages:
+		if page is None:
+			result = None
+		elif parser_pool:
+			result = parser_pool.submit(parse_peak_page, page.content)
+		else:
+			result = parse_peak_page(page.content)
+		pending.append((item, result))
+		if len(pending) > window:
+			item, result = pending.popleft()
+			yield item, result.result() if isinstance(result, Future) else result
+	while pending:
+		item, result = pending.popleft()
+		yield item, result.result() if isinstance(result, Future) else result
+		
+# Hashes the peak data region of a page: the first gray table, which holds
+# every extracted field, so changes elsewhere on the page (ascent counts,
+# banners) don't count as changes to the peak. The schema version is
+# included, so pages stored under an older schema count as changed too.
+def page_hash(content):
+	start = content.find(b'class="gray"')
+	if start >= 0:
+		end = content.find(b'</table>', start)
+		if end >= 0:
+			content = content[start:end]
+	digest = hashlib.blake2b(PEAK_SCHEMA_VERSION, digest_size=16)
+	digest.update(content)
+	return digest.hexdigest()
+	
+# Counts of new, changed and unchanged peak pages seen by scrape_peak_data
+class DeltaCounts:
+	def __init__(self):
+		self.new = 0
+		self.changed = 0
+		self.unchanged = 0
+		self.failed = 0
+		
+	def report(self):
+		print("\n{0} new, {1} changed, {2} unchanged, {3} failed".format(self.new, self.changed, self.unchanged, self.failed))
+		
+# Downloads and extracts each peak's data page, yielding peaks as they finish
+# Peaks with a record in completed are restored from it instead of fetched.
+# Given the database, pages whose content hash matches the stored one skip
+# extraction and the peak is restored from its stored row; with refresh set
+# those peaks are not yielded at all, so only new or changed peaks go on to
+# be written.
+def scrape_peak_data(peaks, fetcher, journal=None, completed={}, parser_pool=None,
+					database=None, refresh=False, delta=None):
+	known_hashes = database.content_hashes() if database else {}
+	unchanged_pids = set()
+	if delta is None:
+		delta = DeltaCounts()
+		
+	def peak_link(peak):
+		if peak.pid in completed:
+			return None
+		return PB_PEAK_FORMAT.format(peak.pid)
+		
+	# Hashes each page, holding back unchanged ones from the parsers
+	def changed_pages(pages):
+		for peak, peak_page in pages:
+			if peak_page is not None:
+				peak.content_hash = page_hash(peak_page.content)
+				stored_hash = known_hashes.get(peak.pid)
+				if stored_hash == peak.content_hash:
+					unchanged_pids.add(peak.pid)
+					delta.unchanged += 1
+					peak_page = None
+				elif stored_hash is None:
+					delta.new += 1
+				else:
+					delta.changed += 1
+			elif peak.pid not in completed:
+				delta.failed += 1
+			yield peak, peak_page
+			
+	pages = changed_pages(fetcher.fetch_stream(peaks, peak_link, PEAK_CACHE_TTL, revalidate=refresh))
+	for peak, parsed in parse_page_stream(pages, parser_pool):
+		if peak.pid in completed:
+			peak.load_record(completed[peak.pid])
+			yield peak
+			continue
+		if peak.pid in unchanged_pids:
+			unchanged_pids.discard(peak.pid)
+			METRICS.increment("peaks_unchanged")
+			if not refresh:
+				peak.load_record(dict(database.get(peak.pid)))
+				yield peak
+			continue
 		print("Retrieving info for \"{0}\"".format(peak.peak_name))
-		peak_link = PB_PEAK_FORMAT.format(peak.pid)
-		try:
-			peak_page = requests.get(peak_link)
-		except requests.exceptions.ConnectionError as err:
-			print("Failed to connect to {0}".format(peak_link))
+		if parsed is None:
+			if not refresh:
+				# Keep what the database already knows about the peak
+				stored_row = database.get(peak.pid) if database else None
+				if stored_row:
+					peak.load_record(dict(stored_row))
+				yield peak
 			continue
-		peak_page_tree = html.fromstring(peak_page.content)
+		record, parse_seconds, extract_seconds = parsed
+		PEAK_EXTRACTOR.tally(record, parse_seconds, extract_seconds)
+		apply_peak_record(peak, record)
 		
-		try:
-			first_table = peak_page_tree.xpath("//table[@class=\"gray\"]")[0]
-			data_rows = first_table.xpath(".//tr")
-			for drow in data_rows:
-				table_data = drow.xpath(".//td")
-				if table_data and (table_data[0].text is not None):
-					if "Latitude" in table_data[0].text and "Longitude" in table_data[0].text:
-						fullcoord = table_data[1].text_content()
-						fullcoord = fullcoord.split("(Dec Deg)")[0]
-						if "E" in fullcoord:
-							fullcoord = fullcoord.split("E")[1]
-						else:
-							fullcoord = fullcoord.split("W")[1]
-						coord_tokens = fullcoord.strip().split(", ")
-						peak.lat = float(coord_tokens[0])
-						peak.long = float(coord_tokens[1])
-					if "Alternate Name(s)" in table_data[0].text:
-						peak.alt_names = table_data[1].text
-					if "State" in table_data[0].text:
-						raw_state = table_data[1].text
-						raw_state = raw_state.replace("(Highest Point)", '')
-						raw_state = raw_state.strip()
-						peak.state = raw_state
-						if peak.state in us_state_abbrev:
-							peak.state_abbrev = us_state_abbrev[peak.state]
-		except ValueError as err:
-			print("Unexpected value in webpage: {0}".format(err))
-		except IndexError:
-			print("Missing expected element")
-			
 		print("Peak Info:")
 		print("  Latitude/Longitude: {0}, {1}".format(peak.lat, peak.long))
 		print("  {0}".format(peak.alt_names))
 		print("  State: {0} ({1})".format(peak.state, peak.state_abbrev))
 		
-		time.sleep(REQUEST_COOLDOWN)
+		if journal:
+			with METRICS.timer("stage_seconds", stage="journal"):
+				journal.record(peak)
+		METRICS.increment("peaks_scraped")
+		yield peak
 		
+# Saves each peak to the database as it passes through
+def store_peak_data(peaks, database):
+	for peak in peaks:
+		with METRICS.timer("stage_seconds", stage="db_upsert"):
+			database.upsert(peak)
+		yield peak
+	database.commit()
+	
+# Writes each peak as a CSV row as soon as it arrives, returning the row count
 def write_peak_data(peaks, filename):
 	print("\nWriting to {0}".format(filename))
 	with open(filename, 'w', newline='') as csvfile:
@@ -179,7 +731,9 @@ def write_peak_data(peaks, filename):
 
 		writer.writeheader()
 		
+		row_count = 0
 		for peak in peaks:
+			start_time = time.perf_counter()
 			lat_long = "{0}, {1}".format(peak.lat, peak.long)
 			writer.writerow(
 					{"Peak": peak.peak_name,
@@ -196,15 +750,13 @@ def write_peak_data(peaks, filename):
 					"Range (Level 6)": peak.range,
 					"Notes": peak.alt_names}
 				)
+			csvfile.flush()
+			row_count += 1
+			METRICS.observe("stage_seconds", time.perf_counter() - start_time, stage="csv_write")
+	return row_count
 
 
-def main():
-	print("Peak Info Scraper v1.0")
-	print("By Timothy Volpe")
-	print("\nFor use with www.peakbagger.com")
-	
-	ignored_unranked = True
-	
+def scrape_list(fetcher, parser_pool, database, ignored_unranked):
 	# Get the link list from the user
 	while True:
 		link = input("\nEnter Link to Peak List: ")
@@ -213,19 +765,15 @@ def main():
 			
 		print("Retrieving list page...")
 		try:
-			list_page = requests.get(link)
-		except requests.exceptions.MissingSchema as err:
-			print(err)
-			continue
-		except requests.exceptions.ConnectionError as err:
-			print("Failed to connect to {0}".format(link))
-			continue
+			list_page = fetcher.fetch(link, LIST_CACHE_TTL)
 		except Exception as err:
 			print(err)
 			return
 		except:
 			print("Unknown exception")
 			return
+		if list_page is None:
+			continue
 		print("Success!")
 		break
 		
@@ -239,10 +787,194 @@ def main():
 	check_peaks = input("Continue scraping each peak's data page (Y/n)?: ")
 	if check_peaks != "Y":
 		return
-	scrape_peak_data(peaks)
+		
+	# Pick up an interrupted scrape from the journal
+	journal = ProgressJournal(JOURNAL_FILENAME)
+	completed = journal.load()
+	if completed:
+		resume = input("Resume previous scrape ({0} peaks done) (Y/n)?: ".format(len(completed)))
+		if resume != "Y":
+			journal.clear()
+			completed = {}
+	if completed:
+		print("Skipping {0} peaks already scraped".format(sum(peak.pid in completed for peak in peaks)))
+		
+	# Stream each scraped peak straight into the database and CSV file
+	with journal:
+		scraped_peaks = scrape_peak_data(peaks, fetcher, journal, completed, parser_pool, database)
+		write_peak_data(store_peak_data(scraped_peaks, database), CSV_FILENAME)
+	journal.clear()
+	PEAK_EXTRACTOR.report()
+	
+# Reads list URLs from a file, one per line, skipping blanks and # comments
+def read_list_links(filename):
+	links = []
+	with open(filename, encoding='utf-8') as list_file:
+		for line in list_file:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				links.append(line)
+	return links
+	
+# Names a list's CSV file after its peakbagger list id, if the link has one
+def list_csv_filename(link, index):
+	list_ids = parse_qs(urlsplit(link).query).get("lid")
+	if list_ids:
+		return "list_{0}.csv".format(list_ids[0])
+	return "list_{0}.csv".format(index + 1)
+	
+# Scrapes every list in the file without prompting. Peaks that appear in
+# several lists are fetched once; each list gets its own CSV file and all
+# unique peaks are written to a merged CSV file.
+def scrape_batch(fetcher, parser_pool, database, list_filename, output_dir, ignored_unranked):
+	links = read_list_links(list_filename)
+	print("Retrieving {0} list pages...".format(len(links)))
+	
+	unique_peaks = {}
+	list_members = []
+	membership_count = 0
+	for index, (link, list_page) in enumerate(fetcher.fetch_stream(links, lambda link: link, LIST_CACHE_TTL)):
+		if list_page is None:
+			print("Skipping list {0}".format(link))
+			continue
+		member_pids = []
+		with METRICS.timer("stage_seconds", stage="list_parse"):
+			for peak in iter_peak_list(ignored_unranked, list_page, verbose=False):
+				if peak.pid not in unique_peaks:
+					unique_peaks[peak.pid] = peak
+				member_pids.append(peak.pid)
+		membership_count += len(member_pids)
+		list_members.append((list_csv_filename(link, index), member_pids))
+		print("  {0}: {1} peaks".format(link, len(member_pids)))
+		
+	print("\n{0} list entries, {1} unique peaks".format(membership_count, len(unique_peaks)))
+	
+	journal = ProgressJournal(JOURNAL_FILENAME)
+	completed = journal.load()
+	if completed:
+		print("Resuming, {0} peaks already scraped".format(sum(pid in completed for pid in unique_peaks)))
+		
+	os.makedirs(output_dir, exist_ok=True)
+	with journal:
+		scraped_peaks = scrape_peak_data(unique_peaks.values(), fetcher, journal, completed, parser_pool, database)
+		write_peak_data(store_peak_data(scraped_peaks, database), os.path.join(output_dir, MERGED_CSV_FILENAME))
+	for filename, member_pids in list_members:
+		write_peak_data((unique_peaks[pid] for pid in member_pids), os.path.join(output_dir, filename))
+	journal.clear()
+	PEAK_EXTRACTOR.report()
+	
+# Re-checks every peak in the database against peakbagger.com, extracting and
+# saving only the peaks whose pages changed. Cached pages are revalidated
+# with the server rather than trusted. Changed peaks are also written to
+# changed_filename if given.
+def refresh_peak_data(fetcher, parser_pool, database, changed_filename=None):
+	peaks = [peak_from_row(row) for row in database.query()]
+	print("Refreshing {0} peaks".format(len(peaks)))
+	delta = DeltaCounts()
+	changed_peaks = store_peak_data(scrape_peak_data(peaks, fetcher, None, {}, parser_pool, database, True, delta), database)
+	if changed_filename:
+		write_peak_data(changed_peaks, changed_filename)
+	else:
+		for peak in changed_peaks:
+			pass
+	delta.report()
+	PEAK_EXTRACTOR.report()
+	
+# Writes the database peaks matching the filters to a CSV file
+def export_peak_data(database, filename, **filters):
+	row_count = write_peak_data((peak_from_row(row) for row in database.query(**filters)), filename)
+	print("Exported {0} of {1} peaks".format(row_count, database.count()))
+
+# Finds peaks in the database around a point or inside a box
+# Prints the matches and writes them to export_filename if given
+def spatial_query(database, export_filename, near=None, radius=None, nearest=None, bbox=None):
+	index = PeakIndex((row["lat"], row["long"], row) for row in database.located())
+	print("Indexed {0} peaks".format(len(index)))
+	if bbox:
+		matches = [(None, point) for point in index.bounding_box(*bbox)]
+	elif nearest:
+		matches = index.nearest(near[0], near[1], nearest)
+	else:
+		matches = index.within(near[0], near[1], radius)
+		
+	print("\n\tPeak Name\t\t\tElevation\tProminance\tDistance")
+	print("-------------------------------------------------------------------------------------------------")
+	for distance, (lat, long, row) in matches:
+		distance_entry = "" if distance is None else "{0:.1f} km".format(distance)
+		print(" {0:<32}{1} ft\t{2} ft\t\t{3}".format(row["peak_name"], row["elevation"], row["prominance"], distance_entry))
+	print("\n{0} peaks found".format(len(matches)))
+	if export_filename:
+		write_peak_data((peak_from_row(row) for distance, (lat, long, row) in matches), export_filename)
+		
+def coordinate_list(count):
+	def parse(text):
+		try:
+			values = [float(value) for value in text.split(",")]
+		except ValueError:
+			raise argparse.ArgumentTypeError("expected {0} comma separated numbers".format(count))
+		if len(values) != count:
+			raise argparse.ArgumentTypeError("expected {0} comma separated numbers".format(count))
+		return values
+	return parse
+
+def main():
+	parser = argparse.ArgumentParser(description="Scrapes peak lists from www.peakbagger.com into CSV files")
+	parser.add_argument("--batch", metavar="FILE", help="scrape every list URL in FILE without prompting")
+	parser.add_argument("--output-dir", default=".", help="directory for batch CSV files (default: current directory)")
+	parser.add_argument("--include-unranked", action="store_true", help="keep unranked peaks in batch mode")
+	parser.add_argument("--database", default=PEAK_DB_FILENAME, help="peak database file (default: {0})".format(PEAK_DB_FILENAME))
+	parser.add_argument("--refresh", action="store_true", help="re-check every database peak, re-extracting only changed pages")
+	parser.add_argument("--changed", metavar="FILE", help="with --refresh, write the new and changed peaks to a CSV file")
+	parser.add_argument("--export", metavar="FILE", help="write peaks from the database to a CSV file instead of scraping")
+	parser.add_argument("--state", help="export only peaks in this state (name or abbreviation)")
+	parser.add_argument("--min-elevation", type=int)
+	parser.add_argument("--max-elevation", type=int)
+	parser.add_argument("--min-prominance", type=int)
+	parser.add_argument("--max-prominance", type=int)
+	parser.add_argument("--range", help="export only peaks in this range")
+	parser.add_argument("--near", type=coordinate_list(2), metavar="LAT,LON", help="find database peaks near a point, with --radius or --nearest")
+	parser.add_argument("--radius", type=float, metavar="KM", help="find peaks within this distance of --near")
+	parser.add_argument("--nearest", type=int, metavar="K", help="find the K peaks closest to --near")
+	parser.add_argument("--bbox", type=coordinate_list(4), metavar="MIN_LAT,MIN_LON,MAX_LAT,MAX_LON", help="find database peaks inside a box")
+	parser.add_argument("--metrics", metavar="FILE", help="write per-stage timings and counters to FILE at the end of the run")
+	parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+	parser.add_argument("--metrics-interval", type=float, metavar="SECONDS", help="also rewrite the metrics file this often during the run")
+	args = parser.parse_args()
+	
+	if args.near or args.bbox:
+		if args.near and not (args.radius or args.nearest):
+			parser.error("--near needs --radius or --nearest")
+		with PeakDatabase(args.database) as database:
+			spatial_query(database, args.export, args.near, args.radius, args.nearest, args.bbox)
+		return
+		
+	if args.export:
+		with PeakDatabase(args.database) as database:
+			export_peak_data(database, args.export, state=args.state,
+							min_elevation=args.min_elevation, max_elevation=args.max_elevation,
+							min_prominance=args.min_prominance, max_prominance=args.max_prominance,
+							range=args.range)
+		return
+	
+	print("Peak Info Scraper v1.0")
+	print("By Timothy Volpe")
+	print("\nFor use with www.peakbagger.com")
+	
+	ignored_unranked = True
 	
-	# Write to CSV file
-	write_peak_data(peaks, CSV_FILENAME)
+	with PageCache(CACHE_FILENAME, CACHE_MAX_SIZE) as cache, PageFetcher(cache=cache) as fetcher, \
+			ProcessPoolExecutor(PARSE_WORKERS) as parser_pool, PeakDatabase(args.database) as database:
+		if args.metrics:
+			reporter = MetricsReporter(METRICS, args.metrics, args.metrics_format, args.metrics_interval)
+		else:
+			reporter = contextlib.nullcontext()
+		with reporter:
+			if args.refresh:
+				refresh_peak_data(fetcher, parser_pool, database, args.changed)
+			elif args.batch:
+				scrape_batch(fetcher, parser_pool, database, args.batch, args.output_dir, not args.include_unranked)
+			else:
+				scrape_list(fetcher, parser_pool, database, ignored_unranked)
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+# Persistent page cache for pb-scrape.py
+# Pages are stored zlib-compressed in a SQLite file keyed by URL, along with
+# the time they were fetched and any validators (ETag/Last-Modified) the
+# server sent. The cache is kept under a size cap by evicting the least
+# recently used pages.
+
+DEFAULT_TTL = 7 * 24 * 60 * 60 # seconds a page is considered fresh
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024 # bytes of compressed pages to keep
+
+class CacheEntry:
+	def __init__(self, url, content, fetched, ttl, etag, last_modified):
+		self.url = url
+		self.content = content
+		self.fetched = fetched
+		self.ttl = ttl
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def is_fresh(self):
+		return time.time() - self.fetched < self.ttl
+
+	# Headers for a conditional request revalidating this entry
+	def validators(self):
+		headers = {}
+		if self.etag:
+			headers["If-None-Match"] = self.etag
+		if self.last_modified:
+			headers["If-Modified-Since"] = self.last_modified
+		return headers
+
+class PageCache:
+	def __init__(self, filename, max_size=DEFAULT_MAX_SIZE, default_ttl=DEFAULT_TTL):
+		self.filename = filename
+		self.max_size = max_size
+		self.default_ttl = default_ttl
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS pages ("
+			"url TEXT PRIMARY KEY, content BLOB NOT NULL, size INTEGER NOT NULL, "
+			"fetched REAL NOT NULL, accessed REAL NOT NULL, ttl REAL NOT NULL, "
+			"etag TEXT, last_modified TEXT)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)")
+		self.connection.commit()
+		self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	# Returns the cached entry for a URL, fresh or stale, or None if not cached
+	def get(self, url):
+		with self.lock:
+			row = self.connection.execute(
+				"SELECT content, fetched, ttl, etag, last_modified FROM pages WHERE url = ?",
+				(url,)).fetchone()
+			if row is None:
+				return None
+			self.connection.execute("UPDATE pages SET accessed = ? WHERE url = ?", (time.time(), url))
+			self.connection.commit()
+		content, fetched, ttl, etag, last_modified = row
+		return CacheEntry(url, zlib.decompress(content), fetched, ttl, etag, last_modified)
+
+	def put(self, url, content, etag=None, last_modified=None, ttl=None):
+		if ttl is None:
+			ttl = self.default_ttl
+		compressed = zlib.compress(content)
+		now = time.time()
+		with self.lock:
+			old_row = self.connection.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+			if old_row:
+				self.total_size -= old_row[0]
+			self.connection.execute(
+				"INSERT OR REPLACE INTO pages (url, content, size, fetched, accessed, ttl, etag, last_modified) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+				(url, compressed, len(compressed), now, now, ttl, etag, last_modified))
+			self.total_size += len(compressed)
+			self.evict()
+			self.connection.commit()
+
+	# Marks a stale entry as fresh again after the server confirmed it is unchanged
+	def refresh(self, url, ttl=None):
+		with self.lock:
+			now = time.time()
+			if ttl is None:
+				self.connection.execute("UPDATE pages SET fetched = ?, accessed = ? WHERE url = ?", (now, now, url))
+			else:
+				self.connection.execute("UPDATE pages SET fetched = ?, accessed = ?, ttl = ? WHERE url = ?", (now, now, ttl, url))
+			self.connection.commit()
+
+	# Drops least recently used pages until the cache fits in max_size
+	# Must be called with the lock held
+	def evict(self):
+		while self.total_size > self.max_size:
+			rows = self.connection.execute("SELECT url, size FROM pages ORDER BY accessed LIMIT 64").fetchall()
+			if not rows:
+				self.total_size = 0
+				break
+			for url, size in rows:
+				if self.total_size <= self.max_size:
+					break
+				self.connection.execute("DELETE FROM pages WHERE url = ?", (url,))
+				self.total_size -= size
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Counters, gauges and latency histograms for pb-scrape.py
+# Everything is keyed by a metric name plus optional labels and can be dumped
+# as JSON or in the Prometheus text format, once or periodically.
+
+# Histogram bucket upper bounds in seconds, from 50 us to 2 minutes
+DEFAULT_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+					0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+class Histogram:
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0
+		self.min = None
+		self.max = None
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	# Upper bound of the bucket holding the given quantile
+	def quantile(self, q):
+		if not self.count:
+			return None
+		target = q * self.count
+		running = 0
+		for index, count in enumerate(self.counts):
+			running += count
+			if running >= target:
+				return self.buckets[index] if index < len(self.buckets) else self.max
+		return self.max
+
+	def snapshot(self):
+		return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+				"mean": self.sum / self.count if self.count else None,
+				"p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+def metric_key(name, labels):
+	if not labels:
+		return name
+	return "{0}{{{1}}}".format(name, ",".join("{0}=\"{1}\"".format(key, labels[key]) for key in sorted(labels)))
+
+class Metrics:
+	def __init__(self, prefix):
+		self.prefix = prefix
+		self.lock = threading.Lock()
+		self.start_time = time.time()
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+
+	def increment(self, name, value=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def set_gauge(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.gauges[key] = value
+
+	def observe(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram()
+			histogram.observe(value)
+
+	# Times the body of a with statement into a histogram
+	@contextmanager
+	def timer(self, name, **labels):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start_time, **labels)
+
+	def counter_value(self, name, **labels):
+		with self.lock:
+			return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+	def snapshot(self):
+		with self.lock:
+			return {"uptime_seconds": time.time() - self.start_time,
+					"counters": {metric_key(name, dict(labels)): value for (name, labels), value in self.counters.items()},
+					"gauges": {metric_key(name, dict(labels)): value for (name, labels), value in self.gauges.items()},
+					"histograms": {metric_key(name, dict(labels)): histogram.snapshot()
+									for (name, labels), histogram in self.histograms.items()}}
+
+	def to_json(self):
+		return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+	def to_prometheus(self):
+		lines = []
+		with self.lock:
+			for (name, labels), value in sorted(self.counters.items()):
+				lines.append("{0} {1}".format(metric_key("{0}_{1}_total".format(self.prefix, name), dict(labels)), value))
+			for (name, labels), value in sorted(self.gauges.items()):
+				lines.append("{0} {1}".format(metric_key("{0}_{1}".format(self.prefix, name), dict(labels)), value))
+			for (name, labels), histogram in sorted(self.histograms.items()):
+				full_name = "{0}_{1}".format(self.prefix, name)
+				running = 0
+				for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+					running += count
+					bucket_labels = dict(labels)
+					bucket_labels["le"] = bound
+					lines.append("{0} {1}".format(metric_key(full_name + "_bucket", bucket_labels), running))
+				lines.append("{0} {1}".format(metric_key(full_name + "_sum", dict(labels)), histogram.sum))
+				lines.append("{0} {1}".format(metric_key(full_name + "_count", dict(labels)), histogram.count))
+		return "\n".join(lines) + "\n"
+
+	# Writes the metrics to a file, replacing it atomically so readers never
+	# see a partial dump
+	def dump(self, filename, format="json"):
+		text = self.to_prometheus() if format == "prometheus" else self.to_json()
+		temp_filename = filename + ".tmp"
+		with open(temp_filename, "w") as metrics_file:
+			metrics_file.write(text)
+		os.replace(temp_filename, filename)
+
+# Dumps the metrics every interval seconds until stopped, and once more at the end
+class MetricsReporter:
+	def __init__(self, metrics, filename, format="json", interval=None):
+		self.metrics = metrics
+		self.filename = filename
+		self.format = format
+		self.interval = interval
+		self.stop_event = threading.Event()
+		self.thread = None
+
+	def __enter__(self):
+		if self.interval:
+			self.thread = threading.Thread(target=self.thread_main, daemon=True)
+			self.thread.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop_event.set()
+		if self.thread:
+			self.thread.join()
+		self.metrics.dump(self.filename, self.format)
+
+	def thread_main(self):
+		while not self.stop_event.wait(self.interval):
+			self.metrics.dump(self.filename, self.format)
@@ -0,0 +1,100 @@
+import math
+from operator import itemgetter
+
+# Spatial index over peak coordinates for pb-scrape.py
+# A static k-d tree on latitude/longitude answers bounding box queries
+# directly. Radius queries search the box around the circle and filter by
+# great-circle distance, and nearest neighbour queries widen a radius search
+# until it holds enough peaks.
+
+EARTH_RADIUS_KM = 6371.0088
+LEAF_SIZE = 16 # points scanned directly instead of split further
+NEAREST_START_RADIUS_KM = 10 # first radius tried by nearest()
+
+def haversine_km(lat1, lon1, lat2, lon2):
+	lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class PeakIndex:
+	# points is an iterable of (lat, lon, item)
+	def __init__(self, points):
+		self.points = list(points)
+		# Arrange the points so every range [lo, hi) larger than a leaf is
+		# split at its middle element on alternating axes
+		stack = [(0, len(self.points), 0)]
+		while stack:
+			lo, hi, axis = stack.pop()
+			if hi - lo <= LEAF_SIZE:
+				continue
+			self.points[lo:hi] = sorted(self.points[lo:hi], key=itemgetter(axis))
+			mid = (lo + hi) // 2
+			stack.append((lo, mid, 1 - axis))
+			stack.append((mid + 1, hi, 1 - axis))
+
+	def __len__(self):
+		return len(self.points)
+
+	# Returns the (lat, lon, item) points inside the box
+	# A box with min_lon > max_lon crosses the antimeridian
+	def bounding_box(self, min_lat, min_lon, max_lat, max_lon):
+		if min_lon > max_lon:
+			return self.bounding_box(min_lat, min_lon, max_lat, 180) + self.bounding_box(min_lat, -180, max_lat, max_lon)
+		low = (min_lat, min_lon)
+		high = (max_lat, max_lon)
+		found = []
+		stack = [(0, len(self.points), 0)]
+		while stack:
+			lo, hi, axis = stack.pop()
+			if hi - lo <= LEAF_SIZE:
+				for point in self.points[lo:hi]:
+					if min_lat <= point[0] <= max_lat and min_lon <= point[1] <= max_lon:
+						found.append(point)
+				continue
+			mid = (lo + hi) // 2
+			point = self.points[mid]
+			if min_lat <= point[0] <= max_lat and min_lon <= point[1] <= max_lon:
+				found.append(point)
+			if low[axis] <= point[axis]:
+				stack.append((lo, mid, 1 - axis))
+			if high[axis] >= point[axis]:
+				stack.append((mid + 1, hi, 1 - axis))
+		return found
+
+	# Returns (distance_km, point) for every point within radius_km, nearest first
+	def within(self, lat, lon, radius_km):
+		angle = radius_km / EARTH_RADIUS_KM
+		delta_lat = math.degrees(angle)
+		min_lat = lat - delta_lat
+		max_lat = lat + delta_lat
+		if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+			# The circle reaches a pole, so it covers every longitude
+			candidates = self.bounding_box(max(min_lat, -90), -180, min(max_lat, 90), 180)
+		else:
+			delta_lon = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(lat)))))
+			min_lon = lon - delta_lon
+			max_lon = lon + delta_lon
+			if min_lon < -180:
+				min_lon += 360
+			if max_lon > 180:
+				max_lon -= 360
+			candidates = self.bounding_box(min_lat, min_lon, max_lat, max_lon)
+		found = []
+		for point in candidates:
+			distance = haversine_km(lat, lon, point[0], point[1])
+			if distance <= radius_km:
+				found.append((distance, point))
+		found.sort(key=itemgetter(0))
+		return found
+
+	# Returns (distance_km, point) for the k points nearest the location
+	def nearest(self, lat, lon, k):
+		k = min(k, len(self.points))
+		if k <= 0:
+			return []
+		radius_km = NEAREST_START_RADIUS_KM
+		while True:
+			found = self.within(lat, lon, radius_km)
+			if len(found) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+				return found[:k]
+			radius_km *= 4
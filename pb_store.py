@@ -0,0 +1,109 @@
+import sqlite3
+import time
+
+# Local peak database for pb-scrape.py
+# Peaks are kept in SQLite keyed on pid and updated in place as they are
+# scraped, with indexes on the columns lists are usually filtered by.
+
+PEAK_COLUMNS = ["pid", "peak_name", "elevation", "prominance", "range", "rank",
+				"lat", "long", "alt_names", "state", "state_abbrev", "county", "content_hash"]
+
+PEAK_INDEXES = [("state", "state, prominance"), ("state_abbrev", "state_abbrev, prominance"),
+				("elevation", "elevation"), ("prominance", "prominance"), ("range", "range")]
+
+# Peaks are committed in batches of this many upserts
+COMMIT_INTERVAL = 100
+
+class PeakDatabase:
+	def __init__(self, filename):
+		self.filename = filename
+		self.connection = sqlite3.connect(filename)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS peaks ("
+			"pid INTEGER PRIMARY KEY, peak_name TEXT NOT NULL, elevation INTEGER, prominance INTEGER, "
+			"range TEXT, rank INTEGER, lat REAL, long REAL, alt_names TEXT, state TEXT, "
+			"state_abbrev TEXT, county TEXT, content_hash TEXT, updated REAL NOT NULL)")
+		# Databases created before content hashes were stored
+		columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(peaks)")]
+		if "content_hash" not in columns:
+			self.connection.execute("ALTER TABLE peaks ADD COLUMN content_hash TEXT")
+		# State lookups are nearly always combined with a prominance cutoff
+		for name, columns in PEAK_INDEXES:
+			self.connection.execute("CREATE INDEX IF NOT EXISTS peaks_{0} ON peaks ({1})".format(name, columns))
+		self.connection.commit()
+		self.pending_upserts = 0
+		self.upsert_sql = (
+			"INSERT INTO peaks ({0}, updated) VALUES ({1}, ?) "
+			"ON CONFLICT(pid) DO UPDATE SET {2}, updated = excluded.updated".format(
+			", ".join(PEAK_COLUMNS), ", ".join("?" * len(PEAK_COLUMNS)),
+			", ".join("{0} = excluded.{0}".format(column) for column in PEAK_COLUMNS[1:])))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		self.connection.commit()
+		self.connection.close()
+
+	# Inserts a peak or updates the stored copy with the same pid
+	def upsert(self, peak):
+		values = [getattr(peak, column, None) for column in PEAK_COLUMNS]
+		values.append(time.time())
+		self.connection.execute(self.upsert_sql, values)
+		self.pending_upserts += 1
+		if self.pending_upserts >= COMMIT_INTERVAL:
+			self.commit()
+
+	def commit(self):
+		self.connection.commit()
+		self.pending_upserts = 0
+
+	def get(self, pid):
+		return self.connection.execute("SELECT * FROM peaks WHERE pid = ?", (pid,)).fetchone()
+
+	# Returns the stored page content hash of every peak, keyed by pid
+	def content_hashes(self):
+		return dict(self.connection.execute("SELECT pid, content_hash FROM peaks WHERE content_hash IS NOT NULL"))
+
+	# Returns the rows that have coordinates
+	def located(self):
+		return self.connection.execute("SELECT * FROM peaks WHERE lat IS NOT NULL AND NOT (lat = 0 AND long = 0)")
+
+	def count(self):
+		return self.connection.execute("SELECT COUNT(*) FROM peaks").fetchone()[0]
+
+	# Returns the rows matching every given filter, highest prominance first
+	# State matches either the full name or the abbreviation
+	def query(self, state=None, min_elevation=None, max_elevation=None,
+			min_prominance=None, max_prominance=None, range=None):
+		conditions = []
+		parameters = []
+		if state:
+			conditions.append("(state_abbrev = ? OR state = ?)")
+			parameters.extend([state, state])
+		if min_elevation is not None:
+			conditions.append("elevation >= ?")
+			parameters.append(min_elevation)
+		if max_elevation is not None:
+			conditions.append("elevation <= ?")
+			parameters.append(max_elevation)
+		if min_prominance is not None:
+			conditions.append("prominance >= ?")
+			parameters.append(min_prominance)
+		if max_prominance is not None:
+			conditions.append("prominance <= ?")
+			parameters.append(max_prominance)
+		if range:
+			conditions.append("range = ?")
+			parameters.append(range)
+		sql = "SELECT * FROM peaks"
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		sql += " ORDER BY prominance DESC"
+		return self.connection.execute(sql, parameters)